@@ -1,19 +1,16 @@
-
 #Librerías
 import streamlit as st
-from PyPDF2 import PdfReader
-from pdf2image import convert_from_bytes
-from io import BytesIO
-from openai import OpenAI
-import json
-import hashlib
 import os
-from Tools_BooksLives import vector_sentimientos, text_to_music,musicgen_generation,clean_text,text_to_imagen,crea_imagen,get_book_insights
+import uuid
+# Tools_BooksLives carga las librerías pesadas y crea los clientes de OpenAI/Replicate en su primer uso
+from Tools_BooksLives import text_to_music,text_to_imagen,get_book_insights,get_client
+from Tools_BooksLives import descargar_imagen, materializar_imagen, url_imagen, ANCHOS_MINIATURA, musica_semantica, imagen_semantica, insights_libro, INSIGHTS_LIBRO
+from Tools_BooksLives import modelo_musicgen, musica_larga_semantica, MUSICA_DURACION, MIME_MUSICA, MUSICGEN_WARMUP, MUSICGEN_WORKER, lanzar_tareas, resultados_a_medida, dividir_texto, despues_de, prefetcher, text_to_speech
+from Tools_BooksLives import linea_emociones, MOOD_LOCAL, EMOCIONES, PAGINAS_POR_BLOQUE
+from Pdf_BooksLives import documento_desde_archivo, DPI_PAGINA, IndiceBusqueda
+from Progreso_BooksLives import AlmacenProgreso, USUARIO_PUBLICO, PREFIJO_ANONIMO
+from Metricas_BooksLives import activar_traza, iniciar_exportadores, PANEL_METRICAS
 import re
-import requests
-from typing import List, Optional
-from pydantic import BaseModel, Field
-import replicate
 
 
 #------------------------------------------------------ Configuración inicial ----------------------------------------------------------#
@@ -21,20 +18,11 @@ import replicate
 #Titulo
 st.title("BooksLives")
 
-# Variables de entorno
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-
-#Conexion ChatGPT
-
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-client = OpenAI()
-
-# Conexión a Replicate
-client_replicate = replicate.Client(REPLICATE_API_TOKEN)
-
 model_tts = 'gpt-4o-mini-tts'
 
+# Precalcular en paralelo los insights y el prompt de imagen (los botones los leen luego de la caché)
+PRECALCULAR_ANALISIS = os.getenv("BOOKSLIVES_PRECALCULAR_ANALISIS", "1") == "1"
+
 #------------------- Configuración global de la página ----------------------------
 st.set_page_config(page_title="BooksLives: El soudtrack de tu lectura", layout="wide", page_icon='📖')
 
@@ -71,16 +59,16 @@ st.markdown("""
 
 
 #---------------- Funciones con caché para evitar regeneración -------------------
-# Función con caché para la generación de audiolibro
+# Función con caché para la generación de audiolibro (se llama con cada parte del texto de la página)
 @st.cache_data(show_spinner="Generando audiolibro...")
-def generate_audiobook(_client, model_tts, text):
+def generate_audiobook(model_tts, text):
     audio_bytes = None
     if not text:
         return None, "No se pudo extraer texto de esta página."
     try:
         if text.strip():
-            speech = _client.audio.speech.create(model=model_tts, voice="onyx", input=text)
-            audio_bytes = speech.read()
+            # El audio queda además en el almacén persistente de artefactos
+            audio_bytes = text_to_speech(text, model_name=model_tts, voice="onyx")
             return audio_bytes, "Audio generado con éxito."
         else:
             return None, "Texto de la página vacío o no válido."   
@@ -89,8 +77,9 @@ def generate_audiobook(_client, model_tts, text):
     
 # Función con caché para la generación de música
 @st.cache_data(show_spinner="Generando música...")
-def get_book_music(prompt):
-    return musicgen_generation(prompt)
+def get_book_music(prompt, _mood=None):
+    # st.cache_data necesita bytes (el audio comprimido es pequeño); el ánimo no entra en la llave (empieza por "_")
+    return bytes(musica_semantica(prompt, mood=_mood))
 
 # Función con caché para la generación de insights
 @st.cache_data(show_spinner="Analizando el texto...")
@@ -98,7 +87,11 @@ def get_book_insights_cached(text):
     """Genera los insights (JSON) y los cachea."""
     # Aquí se llama a tu función original. Usamos el nombre 'get_book_insights_cached' 
     # para distinguir el wrapper cacheado.
-    return get_book_insights(client,book_text=text)
+    return get_book_insights(get_client(),book_text=text)
+
+# Insights de la página combinados con el estado del libro completo (sin caché: el estado del libro avanza al leer)
+def get_book_insights_libro(documento, page_number):
+    return insights_libro(documento).insights_pagina(page_number)
 
 # Función con caché para generar el prompt de generación de imagen
 @st.cache_data(show_spinner="Analizando texto...")
@@ -107,26 +100,71 @@ def get_image_prompt_cached(text):
 
 # Función con caché para generar la imagen
 @st.cache_data(show_spinner="Creando imagen con IA...")
-def get_generated_image_cached(prompt_imagen):
-    output = crea_imagen(prompt_imagen) 
-    if isinstance(output, str):
-        return output
-    elif isinstance(output, list) and output:
-        return str(output[0])
+def get_generated_image_cached(prompt_imagen, _mood=None):
+    output = imagen_semantica(prompt_imagen, mood=_mood)
+    return url_imagen(output)
+
+# Función con caché para servir la imagen generada desde el disco local (miniatura del ancho pedido)
+@st.cache_data(show_spinner="Descargando imagen...")
+def get_imagen_local_cached(image_url, ancho):
+    return materializar_imagen(image_url)[ancho]
+
+# Función con caché para la imagen original (descarga a tamaño completo)
+@st.cache_data(show_spinner=False)
+def get_imagen_original_cached(image_url):
+    return descargar_imagen(image_url)
+
+# Calentamiento opcional de MusicGen (una vez por proceso)
+@st.cache_resource(show_spinner="Cargando modelo de música...")
+def warmup_musicgen():
+    if MUSICGEN_WORKER:
+        # Arranca el trabajador, que carga el modelo fuera de este proceso
+        from Worker_BooksLives import cliente_musicgen
+        cliente_musicgen.submit("calm ambient piano", max_new_tokens=16)
     else:
-        return str(output)
+        modelo_musicgen.warmup()
+    return True
+
+if MUSICGEN_WARMUP:
+    warmup_musicgen()
+
+# Almacén de avance de lectura (uno por proceso, compartido por todas las sesiones)
+@st.cache_resource
+def get_progreso():
+    return AlmacenProgreso()
+
+# Índice de búsqueda de texto completo (uno por proceso, compartido por todas las sesiones)
+@st.cache_resource
+def get_indice_busqueda():
+    return IndiceBusqueda()
+
+# Exportadores de métricas (endpoint /metrics y/o archivo, según las variables de entorno), uno por proceso
+@st.cache_resource
+def get_exportadores_metricas():
+    return iniciar_exportadores()
 
-# Definimos el archivo de progreso de avance de lectura del archivo
-PROGRESS_FILE = "pdf_progress.json"  
+get_exportadores_metricas()
 
 
 #------------------- Interfaz gráfica del lector de PDF ----------------------------
-# Cargar progreso previo (si existe)
-if os.path.exists(PROGRESS_FILE):
-    with open(PROGRESS_FILE, "r") as f:
-        progress = json.load(f)
-else:
-    progress = {}
+# El progreso se lee y escribe por (usuario, libro), sin cargar el de todos los libros en cada rerun
+progreso = get_progreso()
+# Sin sesión iniciada cada lector anónimo tiene su propio id (si compartieran uno, se moverían la página entre sí).
+# Va en la URL (?lector=...) para que recargar o abrir el enlace en otra pestaña recupere su progreso
+usuario = st.user.get("email") if st.user.get("is_logged_in") else None
+anonimo = usuario is None
+if anonimo:
+    lector = st.query_params.get("lector", "")
+    if not re.fullmatch(r"[0-9a-f]{32}", lector):
+        lector = uuid.uuid4().hex
+        st.query_params["lector"] = lector
+    usuario = f"{PREFIJO_ANONIMO}{lector}"
+
+def guardar_progreso(pdf_id, pagina):
+    progreso.set(usuario, pdf_id, pagina)
+    if anonimo:
+        # Última página leída sin sesión: punto de partida de los lectores anónimos nuevos de este libro
+        progreso.set(USUARIO_PUBLICO, pdf_id, pagina)
 
 # Barra de herramientas de la app
 with st.sidebar:
@@ -139,30 +177,41 @@ with st.sidebar:
 
 
 if uploaded_file:
+    # Todo lo que se mida en este rerun (PDF, IA, caché) queda en la traza de la página para el panel de desarrollo
+    traza_pagina = activar_traza("pagina")
+
     # Definimos un layout de dos columnas para la app
     col_lector, col_audio_controls = st.columns([8, 2])
 
     # Columna del lector de PDF
     with col_lector:
-        pdf_bytes = uploaded_file.read()
-        # Convertir PDF a imágenes (una por página)
-        pages = convert_from_bytes(pdf_bytes)
-        num_pages = len(pages)
+        # Documento parseado una sola vez por hash y compartido entre reruns y sesiones
+        documento = documento_desde_archivo(uploaded_file)
+        num_pages = documento.num_pages
 
         # Recuperar página guardada si existe
-        pdf_id = hashlib.md5(pdf_bytes).hexdigest()
-
-        if pdf_id in progress:
-            st.session_state.page_number = progress[pdf_id]
+        pdf_id = documento.pdf_id
+
+        # Un lector sin progreso en este libro parte del guardado como "publico" (JSON migrado o último lector
+        # anónimo) y se lo queda como propio, para no seguir las páginas de otros lectores en los siguientes reruns
+        pagina_guardada = progreso.get(usuario, pdf_id)
+        if pagina_guardada is None:
+            pagina_guardada = progreso.get(USUARIO_PUBLICO, pdf_id)
+            if pagina_guardada is not None:
+                progreso.set(usuario, pdf_id, pagina_guardada)
+        if pagina_guardada is not None:
+            st.session_state.page_number = pagina_guardada
         elif "page_number" not in st.session_state:
             st.session_state.page_number = 1
 
+        traza_pagina.nombre = f"{pdf_id[:8]} · página {st.session_state.page_number}"
+
         # Mostrar número de página
         st.info(f"Página **{st.session_state.page_number}** de **{num_pages}**") # Estilo más limpio
 
-        # Mostrar la página actual
+        # Mostrar la página actual (sólo se renderiza esta página y sus vecinas)
         st.image(
-            pages[st.session_state.page_number - 1], 
+            documento.render(st.session_state.page_number, dpi=DPI_PAGINA), 
             use_container_width=True, # Usa el ancho completo de la columna para la imagen
             caption=f"Página {st.session_state.page_number} de {num_pages}"
         )
@@ -174,9 +223,7 @@ if uploaded_file:
             if st.button("⬅️ Anterior", use_container_width=True):
                 if st.session_state.page_number > 1:
                     st.session_state.page_number -= 1
-                    progress[pdf_id] = st.session_state.page_number
-                    with open(PROGRESS_FILE, "w") as f:
-                        json.dump(progress, f)
+                    guardar_progreso(pdf_id, st.session_state.page_number)
                     st.rerun()         
 
         # Botón siguiente
@@ -184,9 +231,7 @@ if uploaded_file:
             if st.button("Siguiente ➡️", use_container_width=True):
                 if st.session_state.page_number < num_pages:
                     st.session_state.page_number += 1
-                    progress[pdf_id] = st.session_state.page_number
-                    with open(PROGRESS_FILE, "w") as f:
-                        json.dump(progress, f)
+                    guardar_progreso(pdf_id, st.session_state.page_number)
                     st.rerun()
 
         # Campo para ir a página
@@ -200,36 +245,82 @@ if uploaded_file:
             )
             if st.button("Ir", use_container_width=True):
                 st.session_state.page_number = target_page
-                progress[pdf_id] = target_page
-                with open(PROGRESS_FILE, "w") as f:
-                    json.dump(progress, f)
+                guardar_progreso(pdf_id, target_page)
                 st.rerun()
 
+    # -:--------------- Búsqueda en el libro -----------------------------------------#
+    # El índice se construye en segundo plano la primera vez que se sube el libro
+    indice_busqueda = get_indice_busqueda()
+    indice_busqueda.indexar_en_segundo_plano(documento)
+
+    with st.sidebar:
+        st.header("Buscar en el libro")
+        consulta = st.text_input("Palabras a buscar", key="consulta_busqueda")
+        if consulta:
+            indexadas, _ = indice_busqueda.avance(pdf_id)
+            if indexadas < num_pages:
+                st.caption(f"Indexando el libro... {indexadas} de {num_pages} páginas")
+            resultados_busqueda = indice_busqueda.buscar(pdf_id, consulta)
+            if not resultados_busqueda:
+                st.info("No se encontraron resultados.")
+            for pagina, fragmento in resultados_busqueda:
+                # Cada resultado lleva directamente a su página en el lector
+                if st.button(f"Ir a página {pagina}", key=f"resultado_busqueda_{pagina}", use_container_width=True):
+                    st.session_state.page_number = pagina
+                    guardar_progreso(pdf_id, pagina)
+                    st.rerun()
+                st.caption(fragmento)
+        st.markdown("---")
+
     #----------------- Extracción de texto, análisis y construcción de widgets de la aplicación ----------------#
     # Extraer texto de la página actual
-    reader = PdfReader(BytesIO(pdf_bytes))
-    text = reader.pages[st.session_state.page_number - 1].extract_text()
+    text = documento.texto(st.session_state.page_number)
+
+    # Las llamadas de IA sobre la página son independientes: se lanzan todas a la vez y cada resultado
+    # se pinta en su widget conforme va llegando (la latencia es la de la llamada más lenta)
+    # El audiolibro se sintetiza por partes (cortadas en fin de oración) para que la primera suene cuanto antes
+    partes_audiolibro = dividir_texto(text) if text else []
+    tareas = {f"audiolibro_{i}": (generate_audiobook, model_tts, parte) for i, parte in enumerate(partes_audiolibro)}
+    tareas["prompt_musica"] = (text_to_music, text)
+    # Las emociones de la página quedan además en la línea de tiempo del libro
+    linea = linea_emociones(documento)
+    tareas["sentimientos"] = (linea.puntuar, st.session_state.page_number)
+    if PRECALCULAR_ANALISIS:
+        if INSIGHTS_LIBRO:
+            tareas["insights"] = (get_book_insights_libro, documento, st.session_state.page_number)
+        else:
+            tareas["insights"] = (get_book_insights_cached, text)
+        tareas["prompt_imagen"] = (get_image_prompt_cached, text)
+    # Si la página ya se estaba precargando, se espera a esa precarga en lugar de repetir la llamada
+    for nombre_precarga, futuro in prefetcher.reclamar(pdf_id, st.session_state.page_number).items():
+        for nombre in tareas:
+            if nombre == nombre_precarga or nombre.startswith(f"{nombre_precarga}_"):
+                tareas[nombre] = (despues_de, futuro, *tareas[nombre])
+    tareas_pagina = lanzar_tareas(tareas)
+
+    # Ánimo suavizado de las páginas cercanas ya puntuadas para la música y la imagen (espera a las emociones de
+    # esta página, que ya se calculan en paralelo; no hace llamadas extra)
+    def mood_pagina():
+        if not MOOD_LOCAL:
+            return None
+        try:
+            tareas_pagina["sentimientos"].result()
+        except Exception:
+            pass
+        return linea.mood_local(st.session_state.page_number)
+
+    # Precarga especulativa de las páginas siguientes (la página guardada en el progreso es el punto de partida)
+    prefetcher.programar(documento, st.session_state.page_number)
 
     with col_audio_controls:
         # -:--------------- Generación de audiolibro -----------------------------------------#
 
-        audio_bytes, status_message = generate_audiobook(client, model_tts, text) #<...........Verdadera
-        #with open('./audio_lectura_prueba.wav', 'rb') as f:#<...........Linea para desarrollo de pruebas
-         #   audio_bytes = BytesIO(f.read())
-        #status_message = "éxito"
-
-        # Muestra el mensaje de estado (éxito o error/info)
-        if "éxito" in status_message:
-            st.success(status_message)
-        elif "No se pudo" in status_message:
-            st.error(status_message)
-        else:
-            st.info(status_message)
-
-        # Muestra el reproductor solo si hay bytes de audio
+        # Espacios reservados que se llenan cuando termina la tarea del audiolibro
+        estado_audiolibro = st.empty()
         st.caption("Audiolibro")
-        if audio_bytes:
-            st.audio(audio_bytes, format="audio/mp3", start_time=0, sample_rate=None, end_time=None, loop=False, autoplay=False, width="stretch")
+        reproductor_audiolibro = st.empty()
+        # El audio completo va en su propio reproductor para no cortar la primera parte si ya se está escuchando
+        reproductor_completo = st.empty()
         
         st.markdown("---") # Separador visual
 
@@ -243,25 +334,46 @@ if uploaded_file:
 
         with st.sidebar:
             # Música para tu lectura
-            prompt_musica = None
-            try:
-                # Obtener el prompt (la función text_to_music se ejecuta en cada rerun)
-                prompt_musica = text_to_music(text) #<...........Verdadera
-                #prompt_musica = 'Prompt_prueba' #<...........Linea para desarrollo de pruebas
-
-            except Exception as exc:
-                # Manejo de errores de text_to_music
-                st.error(f"Error al procesar texto para música: {exc}")
+            error_prompt_musica = st.empty()
                 
             # El botón dispara la generación
             boton_genera_musica = st.button("Generar música para tu lectura")
 
             if boton_genera_musica:
+                prompt_musica = None
+                mood_musica = None
+                try:
+                    # Se espera al prompt que ya se está calculando en paralelo
+                    prompt_musica = tareas_pagina["prompt_musica"].result()
+                    mood_musica = mood_pagina()
+                except Exception:
+                    # El error se muestra cuando llegan los resultados
+                    pass
+
                 if prompt_musica:
                     with st.spinner("Generando audio... esto puede tardar unos momentos."):
                         try:
                             # 1. Llamar a la función cacheada para obtener los bytes del audio
-                            book_music_bytes = get_book_music(prompt_musica) #<...........Verdadera
+                            if MUSICA_DURACION > 0:
+                                # Música larga: el primer segmento suena mientras se generan los siguientes, que se
+                                # añaden debajo al terminar. Los reproductores no se quitan al acabar: cortarían lo que
+                                # ya se escucha; la pista completa (en bucle) aparece aparte, bajo la barra lateral
+                                avance_musica = st.empty()
+                                vista_previa = st.container()
+                                segmentos_listos = []
+                                def al_segmento(audio_bytes):
+                                    segmentos_listos.append(len(audio_bytes))
+                                    with vista_previa:
+                                        st.caption(f"Segmento {len(segmentos_listos)}")
+                                        st.audio(audio_bytes, format=MIME_MUSICA, autoplay=len(segmentos_listos) == 1)
+                                    avance_musica.caption(f"Segmentos listos: {len(segmentos_listos)} (la pista completa aparecerá al terminar)")
+                                book_music_bytes = bytes(musica_larga_semantica(prompt_musica, duracion=MUSICA_DURACION, al_segmento=al_segmento, mood=mood_musica))
+                                if segmentos_listos:
+                                    avance_musica.caption("Pista completa lista: dale play abajo cuando termine el segmento que escuchas")
+                                else:
+                                    avance_musica.empty()
+                            else:
+                                book_music_bytes = get_book_music(prompt_musica, mood_musica) #<...........Verdadera
                             #with open('./music_prueba.wav', 'rb') as f:  #<...........Linea para desarrollo de pruebas
                             #    book_music_bytes = BytesIO(f.read())
                             
@@ -278,19 +390,22 @@ if uploaded_file:
                     st.warning("No se pudo generar un prompt musical válido para esta página.")
                     st.session_state.book_music_bytes = None
         st.caption('Música para acompañar tu lectura')
+        if MUSICGEN_WORKER:
+            from Worker_BooksLives import cliente_musicgen
+            st.caption(f"Trabajos de música en cola: {cliente_musicgen.profundidad()}")
         #Ejecución del reproductor de manera permanente (caché)
         if st.session_state.book_music_bytes:
             st.audio(
                 st.session_state.book_music_bytes, 
-                format='audio/wav', 
+                format=MIME_MUSICA, 
                 loop=True
             )
         with st.sidebar:
             st.header("Insights del texto")
             st.write('Emociones que describen lo que lees')
-            vecsen=vector_sentimientos(text)
-            #vecsen='Emociones'
-            st.write(vecsen)
+            vecsen_placeholder = st.empty()
+            vecsen_placeholder.info("Analizando emociones...")
+            linea_placeholder = st.empty()
             st.markdown("---")
 
         # -:--------------- Generación de Insights del libro -----------------------------------------#
@@ -306,8 +421,13 @@ if uploaded_file:
             if boton_genera_insights:
                 with st.spinner("Generando insights... esto puede tardar unos momentos."):
                     try:
-                        # 1. Llamar a la función cacheada
-                        insights = get_book_insights_cached(text)
+                        # 1. Usar el resultado en curso si ya se lanzó en paralelo
+                        if "insights" in tareas_pagina:
+                            insights = tareas_pagina["insights"].result()
+                        elif INSIGHTS_LIBRO:
+                            insights = get_book_insights_libro(documento, st.session_state.page_number)
+                        else:
+                            insights = get_book_insights_cached(text)
                         
                         # 2. Guardar el resultado en la sesión
                         st.session_state.page_insights = insights
@@ -349,13 +469,16 @@ if uploaded_file:
             if boton_genera_imagen:
                 with st.spinner("Preparando el prompt y generando la imagen... esto puede tardar un momento."):
                     try:
-                        prompt_imagen = get_image_prompt_cached(text)
+                        if "prompt_imagen" in tareas_pagina:
+                            prompt_imagen = tareas_pagina["prompt_imagen"].result()
+                        else:
+                            prompt_imagen = get_image_prompt_cached(text)
                         
                         if not prompt_imagen:
                             st.warning("No se pudo generar un prompt de imagen válido para esta página.")
                             st.session_state.generated_image_data = None
                         else:
-                            imagen_data = get_generated_image_cached(prompt_imagen)
+                            imagen_data = get_generated_image_cached(prompt_imagen, mood_pagina())
 
                             #image_url = imagen_data
                             #st.markdown(
@@ -377,12 +500,23 @@ if uploaded_file:
             image_url = st.session_state.generated_image_data
             
             st.success("¡Imagen generada!")
-            
-            # Usamos Markdown para crear un enlace clicleable
-            st.markdown(
-                f"Haz clic aquí para ver la imagen generada: **[Ver Imagen Generada]({image_url})**",
-                unsafe_allow_html=True
-            )
+
+            try:
+                # La imagen se descarga una vez y se sirve desde el almacén local (la URL remota puede caducar)
+                st.image(get_imagen_local_cached(image_url, ANCHOS_MINIATURA[1]), use_container_width=True)
+                st.download_button(
+                    "Descargar imagen original",
+                    data=get_imagen_original_cached(image_url),
+                    file_name="bookslives_imagen.webp",
+                    use_container_width=True,
+                )
+            except Exception as e:
+                # Si no se pudo descargar, se muestra el enlace remoto como antes
+                st.warning(f"No se pudo descargar la imagen: {e}")
+                st.markdown(
+                    f"Haz clic aquí para ver la imagen generada: **[Ver Imagen Generada]({image_url})**",
+                    unsafe_allow_html=True
+                )
             
             # Opcional: Mostrar la URL completa en una expansión para copiar
             with st.expander("Mostrar URL completa"):
@@ -391,14 +525,85 @@ if uploaded_file:
         else:
             st.info("Presiona 'Generar Imagen de la Página' en la barra lateral.")
 
-        
-
-
-
-
-
-
-
-
+    # -:--------------- Pintar los resultados de la página conforme van llegando -----------------------------------------#
+    if not partes_audiolibro:
+        estado_audiolibro.error("No se pudo extraer texto de esta página.")
+    partes_listas = {}
+    vista_previa_audiolibro = False
+    nombres_audiolibro = [f"audiolibro_{i}" for i in range(len(partes_audiolibro))]
+    for nombre, resultado, error in resultados_a_medida(tareas_pagina, nombres_audiolibro + ["prompt_musica", "sentimientos"]):
+        if nombre.startswith("audiolibro_"):
+            partes_listas[int(nombre.split("_")[1])] = resultado if error is None else (None, f"No se pudo generar la voz sintética: {error}")
+            #with open('./audio_lectura_prueba.wav', 'rb') as f:#<...........Linea para desarrollo de pruebas
+             #   audio_bytes = BytesIO(f.read())
+            #status_message = "éxito"
+
+            if len(partes_listas) < len(partes_audiolibro):
+                # La primera parte se puede escuchar mientras se generan las demás
+                if nombre == "audiolibro_0" and partes_listas[0][0]:
+                    estado_audiolibro.info(f"Reproduciendo la primera parte ({len(partes_listas)} de {len(partes_audiolibro)} listas)...")
+                    reproductor_audiolibro.audio(partes_listas[0][0], format="audio/mp3", start_time=0, sample_rate=None, end_time=None, loop=False, autoplay=False, width="stretch")
+                    vista_previa_audiolibro = True
+                continue
+
+            # Todas las partes listas: se unen en un único audio
+            errores_audio = [mensaje for audio, mensaje in partes_listas.values() if not audio]
+            status_message = errores_audio[0] if errores_audio else "Audio generado con éxito."
+            audio_bytes = None if errores_audio else b"".join(partes_listas[i][0] for i in range(len(partes_audiolibro)))
+
+            # Muestra el mensaje de estado (éxito o error/info)
+            if "éxito" in status_message:
+                estado_audiolibro.success(status_message)
+            elif "No se pudo" in status_message:
+                estado_audiolibro.error(status_message)
+            else:
+                estado_audiolibro.info(status_message)
+
+            # Muestra el reproductor solo si hay bytes de audio
+            if audio_bytes:
+                if vista_previa_audiolibro:
+                    # La primera parte sigue en su reproductor; la página completa aparece debajo
+                    estado_audiolibro.success("Audio generado con éxito. Abajo está la página completa.")
+                    reproductor = reproductor_completo
+                else:
+                    reproductor = reproductor_audiolibro
+                reproductor.audio(audio_bytes, format="audio/mp3", start_time=0, sample_rate=None, end_time=None, loop=False, autoplay=False, width="stretch")
 
+        elif nombre == "prompt_musica":
+            # Manejo de errores de text_to_music
+            if error is not None:
+                error_prompt_musica.error(f"Error al procesar texto para música: {error}")
 
+        elif nombre == "sentimientos":
+            if error is not None:
+                vecsen_placeholder.error(f"No se pudieron analizar las emociones: {error}")
+            else:
+                vecsen_placeholder.write(resultado if resultado is not None else "Página sin texto.")
+
+            # Línea de tiempo de emociones del libro (suavizada y por bloques de páginas)
+            with linea_placeholder.container():
+                with st.expander("Emociones a lo largo del libro"):
+                    import pandas as pd
+
+                    puntuadas, total = linea.avance()
+                    st.caption(f"Páginas analizadas: {puntuadas} de {total}")
+                    st.line_chart(pd.DataFrame(linea.suavizada(), columns=EMOCIONES, index=pd.RangeIndex(1, total + 1, name="página")))
+                    bloques = linea.por_bloque()
+                    inicios = range(1, total + 1, PAGINAS_POR_BLOQUE)
+                    st.bar_chart(pd.DataFrame(bloques, columns=EMOCIONES, index=pd.Index(inicios, name=f"bloque de {PAGINAS_POR_BLOQUE} páginas desde")))
+                    if puntuadas < total and st.button("Analizar todo el libro", key="completar_linea_emociones"):
+                        linea.completar_en_segundo_plano()
+                        st.toast("Analizando las emociones del resto del libro en segundo plano.", icon="📈")
+
+    # -:--------------- Panel de desarrollo: desglose por etapa de la página actual -----------------------------------------#
+    if PANEL_METRICAS:
+        with st.sidebar:
+            with st.expander("Panel de desarrollo"):
+                desglose = traza_pagina.desglose()
+                aciertos = sum(fila["cache"] == "hit" for fila in desglose)
+                fallos = sum(fila["cache"] == "miss" for fila in desglose)
+                st.caption(
+                    f"{traza_pagina.nombre}: {len(desglose)} etapas medidas · "
+                    f"{sum(fila['tokens'] for fila in desglose)} tokens · caché {aciertos} aciertos / {fallos} fallos"
+                )
+                st.dataframe(desglose, use_container_width=True, hide_index=True)
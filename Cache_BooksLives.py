@@ -0,0 +1,413 @@
+# Aquí definimos el almacén persistente de resultados de BooksLives (audio, música, insights, sentimientos e imágenes)
+
+# Librerias a utilizar
+import functools
+import hashlib
+import inspect
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+import atexit
+import numpy as np
+from Metricas_BooksLives import medir, tamano
+
+#------------------------------------------------------ Configuración del almacén -----------------------------------------------#
+
+# Carpeta donde se guardan el índice SQLite y los blobs (compartida por réplicas si es un volumen común)
+CACHE_DIR = os.getenv("BOOKSLIVES_CACHE_DIR", ".bookslives_cache")
+# Tamaño máximo del almacén antes de expulsar los artefactos menos usados
+CACHE_MAX_BYTES = int(os.getenv("BOOKSLIVES_CACHE_MAX_MB", "2048")) * 1024 * 1024
+# Llamadas simultáneas máximas por backend (compartidas por todas las sesiones del proceso)
+LIMITES_BACKEND = {
+    "openai": int(os.getenv("BOOKSLIVES_LIMITE_OPENAI", "16")),
+    "musicgen": int(os.getenv("BOOKSLIVES_LIMITE_MUSICGEN", "1")),
+    "replicate": int(os.getenv("BOOKSLIVES_LIMITE_REPLICATE", "4")),
+}
+# Similitud coseno mínima para reutilizar una música o imagen de una página parecida
+SIMILITUD_MINIMA = float(os.getenv("BOOKSLIVES_SIMILITUD_MINIMA", "0.92"))
+
+#------------------------------------------------------ Almacén de artefactos ---------------------------------------------------#
+
+class AlmacenArtefactos:
+    """
+    Almacén direccionado por contenido: índice en SQLite y contenido en archivos blob.
+    La llave es un hash de (función, modelo, versión del prompt, entrada). Expulsión LRU por tamaño.
+    """
+    def __init__(self, directorio: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _conexion(self):
+        if self._conn is None:
+            os.makedirs(os.path.join(self.directorio, "blobs"), exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.directorio, "artefactos.db"), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS artefactos (
+                    llave TEXT PRIMARY KEY,
+                    funcion TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    tamano INTEGER NOT NULL,
+                    creado REAL NOT NULL,
+                    accedido REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_artefactos_accedido ON artefactos (accedido)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def llave(funcion, modelo, version, entrada):
+        """Hash estable de (función, modelo, versión del prompt, entrada)."""
+        contenido = json.dumps([funcion, modelo, version, entrada], sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+    def _ruta(self, llave):
+        return os.path.join(self.directorio, "blobs", llave[:2], llave)
+
+    def get(self, llave, funcion="", contar=True):
+        """Devuelve (encontrado, valor)."""
+        with self._lock:
+            fila = self._conexion().execute("SELECT tipo FROM artefactos WHERE llave = ?", (llave,)).fetchone()
+            if fila is None:
+                if contar:
+                    self.misses[funcion] += 1
+                return False, None
+            try:
+                with open(self._ruta(llave), "rb") as f:
+                    contenido = f.read()
+            except FileNotFoundError:
+                # El índice apunta a un blob que ya no existe
+                self._conexion().execute("DELETE FROM artefactos WHERE llave = ?", (llave,))
+                self._conexion().commit()
+                if contar:
+                    self.misses[funcion] += 1
+                return False, None
+            self._conexion().execute("UPDATE artefactos SET accedido = ? WHERE llave = ?", (time.time(), llave))
+            self._conexion().commit()
+            if contar:
+                self.hits[funcion] += 1
+        if fila[0] == "bytes":
+            return True, contenido
+        return True, json.loads(contenido.decode("utf-8"))
+
+    def put(self, llave, valor, funcion=""):
+        if isinstance(valor, (bytes, bytearray, memoryview)):
+            # Se escribe directamente desde el buffer, sin copiarlo
+            tipo, contenido = "bytes", memoryview(valor).cast("B")
+        else:
+            # Los objetos no serializables (p. ej. la salida de Replicate) se guardan como texto
+            tipo, contenido = "json", json.dumps(valor, default=str, ensure_ascii=False).encode("utf-8")
+
+        ruta = self._ruta(llave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, "wb") as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+
+        ahora = time.time()
+        with self._lock:
+            conn = self._conexion()
+            conn.execute(
+                "INSERT OR REPLACE INTO artefactos (llave, funcion, tipo, tamano, creado, accedido) VALUES (?, ?, ?, ?, ?, ?)",
+                (llave, funcion, tipo, contenido.nbytes if tipo == "bytes" else len(contenido), ahora, ahora),
+            )
+            conn.commit()
+            self._expulsar()
+
+    def _expulsar(self):
+        # Expulsión LRU hasta quedar por debajo del tamaño máximo (se llama con el lock tomado)
+        conn = self._conexion()
+        total = conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM artefactos").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for llave, tamano_blob in conn.execute("SELECT llave, tamano FROM artefactos ORDER BY accedido").fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._ruta(llave))
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM artefactos WHERE llave = ?", (llave,))
+            total -= tamano_blob
+        conn.commit()
+
+    def stats(self):
+        """Contadores de aciertos/fallos por función y tamaño ocupado."""
+        with self._lock:
+            n, total = self._conexion().execute("SELECT COUNT(*), COALESCE(SUM(tamano), 0) FROM artefactos").fetchone()
+        return {
+            "artefactos": n,
+            "bytes": total,
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+        }
+
+
+almacen = AlmacenArtefactos()
+
+# Contexto que bloquea un archivo de estado entre procesos (la app y pregenera.py pueden escribirlo a la vez),
+# para que cada uno lea lo que hay en disco, lo combine con lo suyo y lo reescriba sin perder lo del otro
+@contextmanager
+def bloqueo_archivo(ruta):
+    import fcntl
+
+    os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+    with open(f"{ruta}.lock", "a") as cerrojo:
+        fcntl.flock(cerrojo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(cerrojo, fcntl.LOCK_UN)
+
+#------------------------------------------------------ Coalescencia de llamadas y límites por backend --------------------------#
+
+class SingleFlight:
+    """
+    Agrupa llamadas idénticas concurrentes: la primera llamada con una llave hace el trabajo
+    y las demás que llegan mientras tanto esperan su resultado.
+    """
+    def __init__(self):
+        self._en_curso = {}
+        self._lock = threading.Lock()
+        self.coalescidas = Counter()
+
+    def do(self, llave, funcion, nombre=""):
+        with self._lock:
+            llamada = self._en_curso.get(llave)
+            lider = llamada is None
+            if lider:
+                llamada = self._en_curso[llave] = Future()
+            else:
+                self.coalescidas[nombre] += 1
+        if not lider:
+            return llamada.result()
+        try:
+            resultado = funcion()
+        except BaseException as exc:
+            llamada.set_exception(exc)
+            raise
+        else:
+            llamada.set_result(resultado)
+            return resultado
+        finally:
+            with self._lock:
+                del self._en_curso[llave]
+
+    def en_curso(self):
+        with self._lock:
+            return len(self._en_curso)
+
+
+single_flight = SingleFlight()
+limites_backend = {backend: threading.BoundedSemaphore(limite) for backend, limite in LIMITES_BACKEND.items()}
+
+# Función que cambia el número de llamadas simultáneas permitidas a un backend (p. ej. desde pregenera.py)
+def configurar_limites(**limites):
+    for backend, limite in limites.items():
+        if limite is not None:
+            limites_backend[backend] = threading.BoundedSemaphore(limite)
+
+#------------------------------------------------------ Decorador de funciones ------------------------------------------------#
+
+# Decorador que guarda en el almacén el resultado de una función de Tools_BooksLives.
+# Las llamadas concurrentes con la misma llave se ejecutan una sola vez y, si se indica `backend`,
+# respetan su límite de llamadas simultáneas.
+# Los argumentos en `ignorar` (p. ej. el cliente de OpenAI) no forman parte de la llave.
+def almacenado(funcion, modelo="", version="", backend=None, ignorar=("client", "_client")):
+    def decorador(fn):
+        firma = inspect.signature(fn)
+
+        def entrada_de(*args, **kwargs):
+            argumentos = firma.bind(*args, **kwargs)
+            argumentos.apply_defaults()
+            return {k: v for k, v in argumentos.arguments.items() if k not in ignorar}
+
+        def llave(*args, **kwargs):
+            entrada = entrada_de(*args, **kwargs)
+            return almacen.llave(funcion, entrada.get("model_name", modelo), version, entrada)
+
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            entrada = entrada_de(*args, **kwargs)
+            modelo_llamada = entrada.get("model_name", modelo)
+            clave = almacen.llave(funcion, modelo_llamada, version, entrada)
+            # Cada llamada queda medida (tiempo, bytes, resultado de caché) para Metricas_BooksLives
+            with medir(funcion, modelo_llamada, entrada=entrada) as tramo:
+                encontrado, valor = almacen.get(clave, funcion)
+                if encontrado:
+                    tramo.cache = "hit"
+                    tramo.bytes_salida = tamano(valor)
+                    return valor
+
+                # Si esta llamada no ejecuta `calcular`, otra idéntica en curso hizo el trabajo
+                tramo.cache = "coalescida"
+                def calcular():
+                    # Otra llamada pudo haber terminado entre la consulta al almacén y este punto
+                    encontrado, valor = almacen.get(clave, funcion, contar=False)
+                    if encontrado:
+                        tramo.cache = "hit"
+                        return valor
+                    tramo.cache = "miss"
+                    if backend in limites_backend:
+                        with limites_backend[backend]:
+                            valor = fn(*args, **kwargs)
+                    else:
+                        valor = fn(*args, **kwargs)
+                    if valor is not None:
+                        almacen.put(clave, valor, funcion)
+                    return valor
+
+                valor = single_flight.do(clave, calcular, funcion)
+                tramo.bytes_salida = tamano(valor)
+                return valor
+
+        envoltura.llave = llave
+        return envoltura
+    return decorador
+
+#------------------------------------------------------ Caché semántica ------------------------------------------------------#
+
+class IndiceVectorial:
+    """
+    Índice de embeddings normalizados en una matriz NumPy, con búsqueda por similitud coseno.
+    Se guarda en disco dentro del almacén para sobrevivir a reinicios.
+    """
+    def __init__(self, nombre, directorio=CACHE_DIR, guardar_cada=20, modelo=""):
+        # El modelo de embeddings va en el nombre: vectores de otro modelo (otra dimensión) no son comparables
+        sufijo = f"_{re.sub(r'[^A-Za-z0-9.-]+', '-', modelo)}" if modelo else ""
+        self.ruta = os.path.join(directorio, f"indice_{nombre}{sufijo}.npz")
+        self.guardar_cada = guardar_cada
+        self._vectores = None   # matriz (capacidad, dimensión) float32
+        self._valores = []
+        self._sin_guardar = 0
+        self._lock = threading.Lock()
+        self._combinar_disco()
+        atexit.register(self.guardar)
+
+    def _combinar_disco(self):
+        # Suma las entradas que otro proceso (pregenera.py, otra réplica) guardó y aquí no están (con el lock tomado)
+        if not os.path.exists(self.ruta):
+            return
+        try:
+            datos = np.load(self.ruta, allow_pickle=False)
+            vectores, valores = datos["vectores"].astype(np.float32), [str(v) for v in datos["valores"]]
+        except (OSError, ValueError, KeyError):
+            return
+        conocidos = set(self._valores)
+        nuevos = [i for i, valor in enumerate(valores) if valor not in conocidos]
+        if not nuevos:
+            return
+        n = len(self._valores)
+        if self._vectores is None:
+            self._vectores = vectores[nuevos]
+        elif vectores.shape[1] != self._vectores.shape[1]:
+            return
+        else:
+            self._vectores = np.concatenate([self._vectores[:n], vectores[nuevos]])
+        self._valores.extend(valores[i] for i in nuevos)
+
+    def __len__(self):
+        return len(self._valores)
+
+    @staticmethod
+    def _normalizar(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norma = np.linalg.norm(vector)
+        return vector / norma if norma > 0 else vector
+
+    def buscar(self, vector):
+        """Devuelve (similitud, valor) del vecino más cercano, o (0.0, None) si el índice está vacío."""
+        vector = self._normalizar(vector)
+        with self._lock:
+            n = len(self._valores)
+            if n == 0:
+                return 0.0, None
+            similitudes = self._vectores[:n] @ vector
+            mejor = int(np.argmax(similitudes))
+            return float(similitudes[mejor]), self._valores[mejor]
+
+    def agregar(self, vector, valor):
+        vector = self._normalizar(vector)
+        with self._lock:
+            n = len(self._valores)
+            if self._vectores is None:
+                self._vectores = np.empty((64, len(vector)), dtype=np.float32)
+            elif n == len(self._vectores):
+                # Crecimiento geométrico para que agregar sea O(1) amortizado
+                self._vectores = np.concatenate([self._vectores, np.empty_like(self._vectores)])
+            self._vectores[n] = vector
+            self._valores.append(valor)
+            self._sin_guardar += 1
+            guardar = self._sin_guardar >= self.guardar_cada
+        if guardar:
+            self.guardar()
+
+    def guardar(self):
+        with self._lock:
+            if not self._sin_guardar:
+                return
+            # Bajo el bloqueo del archivo se combina primero con el disco, para no borrar lo que guardaron otros procesos
+            with bloqueo_archivo(self.ruta):
+                self._combinar_disco()
+                n = len(self._valores)
+                temporal = f"{self.ruta}.tmp.npz"
+                np.savez(temporal, vectores=self._vectores[:n], valores=np.array(self._valores, dtype=str))
+                os.replace(temporal, self.ruta)
+            self._sin_guardar = 0
+
+
+class CacheSemantica:
+    """
+    Reutiliza un resultado ya generado cuando la entrada nueva es suficientemente parecida (similitud coseno)
+    a una anterior. Guarda como valor la entrada original, para recuperar el artefacto con su llave exacta.
+    """
+    def __init__(self, nombre, umbral=SIMILITUD_MINIMA, directorio=CACHE_DIR, modelo=""):
+        self.umbral = umbral
+        self.indice = IndiceVectorial(nombre, directorio, modelo=modelo)
+        self.reutilizadas = 0
+        self.nuevas = 0
+        self._lock = threading.Lock()
+
+    def _parecida(self, vector):
+        similitud, anterior = self.indice.buscar(vector)
+        if anterior is not None and similitud >= self.umbral:
+            with self._lock:
+                self.reutilizadas += 1
+            return anterior
+        return None
+
+    def obtener(self, vector, entrada, generar):
+        """
+        Genera (o reutiliza) el resultado de `entrada` con `generar`. Una entrada nueva sólo se indexa después
+        de generarse bien, para que un fallo no deje en el índice una entrada sin artefacto que reutilizar.
+        """
+        anterior = self._parecida(vector)
+        if anterior is not None:
+            return generar(anterior)
+        resultado = generar(entrada)
+        self.indice.agregar(vector, entrada)
+        with self._lock:
+            self.nuevas += 1
+        return resultado
+
+    def stats(self):
+        total = self.reutilizadas + self.nuevas
+        return {
+            "entradas": len(self.indice),
+            "reutilizadas": self.reutilizadas,
+            "nuevas": self.nuevas,
+            "tasa_reutilizacion": self.reutilizadas / total if total else 0.0,
+        }
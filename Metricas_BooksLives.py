@@ -0,0 +1,290 @@
+# Aquí definimos la instrumentación de BooksLives: tiempo de pared, bytes de entrada y salida, tokens, aciertos de caché
+# y modelo de cada etapa del pipeline, con exportación en el formato de texto de Prometheus (endpoint HTTP o archivo)
+# y el desglose de la página actual para el panel de desarrollo.
+
+# Librerias a utilizar
+import atexit
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+#------------------------------------------------------ Configuración de las métricas -------------------------------------------#
+
+# Puerto del endpoint /metrics (0 = sin endpoint)
+METRICAS_PUERTO = int(os.getenv("BOOKSLIVES_METRICAS_PUERTO", "0"))
+# Archivo donde se vuelcan periódicamente las métricas (vacío = sin archivo), p. ej. para el textfile collector
+METRICAS_ARCHIVO = os.getenv("BOOKSLIVES_METRICAS_ARCHIVO", "")
+METRICAS_INTERVALO = float(os.getenv("BOOKSLIVES_METRICAS_INTERVALO", "15"))
+# Muestra en la barra lateral el desglose por etapa de la página actual
+PANEL_METRICAS = os.getenv("BOOKSLIVES_PANEL_METRICAS", "0") == "1"
+# Límites (segundos) de las cubetas del histograma de latencia
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#------------------------------------------------------ Tramos y trazas -------------------------------------------------------#
+
+class Tramo:
+    """Una ejecución medida de una etapa: se llena mientras la etapa corre y se registra al terminar."""
+    def __init__(self, etapa, modelo="", profundidad=0):
+        self.etapa = etapa
+        self.modelo = modelo
+        self.profundidad = profundidad
+        self.inicio = time.perf_counter()
+        self.duracion = 0.0
+        self.bytes_entrada = 0
+        self.bytes_salida = 0
+        self.tokens_entrada = 0
+        self.tokens_salida = 0
+        self.cache = ""      # "hit", "miss", "coalescida" o vacío si la etapa no usa caché
+        self.error = ""
+
+
+class Traza:
+    """Tramos de una página, en el orden en que empezaron (para el panel de desarrollo)."""
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.inicio = time.perf_counter()
+        self.tramos = []
+        self._lock = threading.Lock()
+
+    def agregar(self, tramo):
+        with self._lock:
+            self.tramos.append(tramo)
+
+    def desglose(self):
+        with self._lock:
+            tramos = sorted(self.tramos, key=lambda tramo: tramo.inicio)
+        return [
+            {
+                "etapa": "  " * tramo.profundidad + tramo.etapa,
+                "modelo": tramo.modelo,
+                "inicio_ms": round(1000 * (tramo.inicio - self.inicio), 1),
+                "ms": round(1000 * tramo.duracion, 1),
+                "cache": tramo.cache,
+                "bytes_entrada": tramo.bytes_entrada,
+                "bytes_salida": tramo.bytes_salida,
+                "tokens": tramo.tokens_entrada + tramo.tokens_salida,
+                "error": tramo.error,
+            }
+            for tramo in tramos
+        ]
+
+#------------------------------------------------------ Registro de métricas -------------------------------------------------#
+
+class RegistroMetricas:
+    """Acumulados por (etapa, modelo) de todo el proceso: histograma de latencia, bytes, tokens, caché y errores."""
+    def __init__(self, cubetas=CUBETAS_SEGUNDOS):
+        self.cubetas = cubetas
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _nueva_serie(self):
+        return {
+            "cubetas": [0] * len(self.cubetas), "suma": 0.0, "cuenta": 0, "errores": 0,
+            "bytes_entrada": 0, "bytes_salida": 0, "tokens_entrada": 0, "tokens_salida": 0,
+            "cache": defaultdict(int),
+        }
+
+    def registrar(self, tramo):
+        with self._lock:
+            serie = self._series.get((tramo.etapa, tramo.modelo))
+            if serie is None:
+                serie = self._series[(tramo.etapa, tramo.modelo)] = self._nueva_serie()
+            for indice, limite in enumerate(self.cubetas):
+                if tramo.duracion <= limite:
+                    serie["cubetas"][indice] += 1
+                    break
+            serie["suma"] += tramo.duracion
+            serie["cuenta"] += 1
+            serie["errores"] += bool(tramo.error)
+            serie["bytes_entrada"] += tramo.bytes_entrada
+            serie["bytes_salida"] += tramo.bytes_salida
+            serie["tokens_entrada"] += tramo.tokens_entrada
+            serie["tokens_salida"] += tramo.tokens_salida
+            if tramo.cache:
+                serie["cache"][tramo.cache] += 1
+
+    def resumen(self):
+        """Copia de los acumulados: {(etapa, modelo): serie}."""
+        with self._lock:
+            return {llave: {**serie, "cubetas": list(serie["cubetas"]), "cache": dict(serie["cache"])} for llave, serie in self._series.items()}
+
+    def exportar(self):
+        """Métricas en el formato de texto de Prometheus."""
+        series = sorted(self.resumen().items())
+        lineas = [
+            "# HELP bookslives_etapa_segundos Tiempo de pared de cada etapa del pipeline.",
+            "# TYPE bookslives_etapa_segundos histogram",
+        ]
+        for (etapa, modelo), serie in series:
+            etiquetas = _etiquetas(etapa=etapa, modelo=modelo)
+            acumulado = 0
+            for limite, cuenta in zip(self.cubetas, serie["cubetas"]):
+                acumulado += cuenta
+                lineas.append(f'bookslives_etapa_segundos_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+            lineas.append(f'bookslives_etapa_segundos_bucket{{{etiquetas},le="+Inf"}} {serie["cuenta"]}')
+            lineas.append(f"bookslives_etapa_segundos_sum{{{etiquetas}}} {serie['suma']:.6f}")
+            lineas.append(f"bookslives_etapa_segundos_count{{{etiquetas}}} {serie['cuenta']}")
+
+        contadores = (
+            ("bookslives_etapa_errores_total", "Ejecuciones de la etapa que terminaron con error.", lambda s: [({}, s["errores"])]),
+            ("bookslives_etapa_bytes_total", "Bytes recibidos y producidos por la etapa.",
+             lambda s: [({"direccion": "entrada"}, s["bytes_entrada"]), ({"direccion": "salida"}, s["bytes_salida"])]),
+            ("bookslives_tokens_total", "Tokens de las APIs de lenguaje consumidos por la etapa.",
+             lambda s: [({"tipo": "entrada"}, s["tokens_entrada"]), ({"tipo": "salida"}, s["tokens_salida"])]),
+            ("bookslives_cache_total", "Consultas al almacén de artefactos por resultado.",
+             lambda s: [({"resultado": resultado}, cuenta) for resultado, cuenta in sorted(s["cache"].items())]),
+        )
+        for nombre, ayuda, valores in contadores:
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} counter")
+            for (etapa, modelo), serie in series:
+                for extra, valor in valores(serie):
+                    lineas.append(f"{nombre}{{{_etiquetas(etapa=etapa, modelo=modelo, **extra)}}} {valor}")
+        return "\n".join(lineas) + "\n"
+
+
+registro = RegistroMetricas()
+_traza_actual = contextvars.ContextVar("bookslives_traza", default=None)
+_tramo_actual = contextvars.ContextVar("bookslives_tramo", default=None)
+
+def _etiquetas(**etiquetas):
+    escapar = lambda valor: str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{nombre}="{escapar(valor)}"' for nombre, valor in etiquetas.items())
+
+#------------------------------------------------------ Medición --------------------------------------------------------------#
+
+# Función que estima el tamaño en bytes de un valor (argumentos o resultado de una etapa) sin copiarlo
+def tamano(valor):
+    if valor is None:
+        return 0
+    if isinstance(valor, memoryview):
+        return valor.nbytes
+    if isinstance(valor, (bytes, bytearray)):
+        return len(valor)
+    if isinstance(valor, str):
+        return len(valor.encode("utf-8"))
+    if isinstance(valor, (int, float)):
+        return 8
+    if isinstance(valor, dict):
+        return sum(tamano(v) for v in valor.values())
+    if isinstance(valor, (list, tuple)):
+        return sum(tamano(v) for v in valor)
+    return int(getattr(valor, "nbytes", 0))
+
+# Contexto que mide una etapa; el tramo que entrega se puede completar (bytes de salida, caché, tokens) mientras corre
+@contextmanager
+def medir(etapa, modelo="", entrada=None):
+    padre = _tramo_actual.get()
+    tramo = Tramo(etapa, modelo, profundidad=padre.profundidad + 1 if padre is not None else 0)
+    tramo.bytes_entrada = tamano(entrada)
+    token = _tramo_actual.set(tramo)
+    try:
+        yield tramo
+    except BaseException as exc:
+        tramo.error = type(exc).__name__
+        raise
+    finally:
+        tramo.duracion = time.perf_counter() - tramo.inicio
+        _tramo_actual.reset(token)
+        registro.registrar(tramo)
+        traza = _traza_actual.get()
+        if traza is not None:
+            traza.agregar(tramo)
+
+# Decorador que mide cada llamada de una función (bytes de entrada = argumentos, de salida = resultado)
+def medido(etapa=None, modelo=""):
+    def decorador(fn):
+        nombre = etapa or fn.__name__
+
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            with medir(nombre, modelo, entrada=(args, kwargs)) as tramo:
+                resultado = fn(*args, **kwargs)
+                tramo.bytes_salida = tamano(resultado)
+                return resultado
+        return envoltura
+    return decorador
+
+# Función que suma al tramo en curso los tokens que reporta una respuesta de OpenAI
+def registrar_tokens(respuesta):
+    tramo = _tramo_actual.get()
+    uso = getattr(respuesta, "usage", None)
+    if tramo is None or uso is None:
+        return
+    tramo.tokens_entrada += getattr(uso, "prompt_tokens", 0) or getattr(uso, "input_tokens", 0) or 0
+    tramo.tokens_salida += getattr(uso, "completion_tokens", 0) or getattr(uso, "output_tokens", 0) or 0
+
+# Función que marca el resultado de caché del tramo en curso (para etapas con caché propia, p. ej. el render)
+def registrar_cache(resultado):
+    tramo = _tramo_actual.get()
+    if tramo is not None:
+        tramo.cache = resultado
+
+#------------------------------------------------------ Trazas por página ------------------------------------------------------#
+
+# Función que empieza la traza de una página: lo que se mida desde este hilo (y desde las tareas lanzadas con su contexto)
+# queda en ella
+def activar_traza(nombre):
+    traza = Traza(nombre)
+    _traza_actual.set(traza)
+    return traza
+
+# Función que envuelve una tarea para que corra en otro hilo con el contexto actual (traza y tramo padre)
+def con_contexto(funcion):
+    return functools.partial(contextvars.copy_context().run, funcion)
+
+#------------------------------------------------------ Exportación -----------------------------------------------------------#
+
+_exportadores = {}
+_lock_exportadores = threading.Lock()
+
+# Función que escribe las métricas en un archivo (escritura atómica, para que el lector nunca vea un archivo a medias)
+def escribir_metricas(ruta=METRICAS_ARCHIVO):
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "w") as f:
+        f.write(registro.exportar())
+    os.replace(temporal, ruta)
+
+# Función que levanta el endpoint HTTP /metrics en un hilo aparte
+def servir_metricas(puerto=METRICAS_PUERTO):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Manejador(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            datos = registro.exportar().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+    servidor = ThreadingHTTPServer(("0.0.0.0", puerto), Manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="bookslives-metricas", daemon=True).start()
+    return servidor
+
+# Función que arranca (una sola vez por proceso) los exportadores configurados por variables de entorno
+def iniciar_exportadores(puerto=METRICAS_PUERTO, archivo=METRICAS_ARCHIVO, intervalo=METRICAS_INTERVALO):
+    with _lock_exportadores:
+        if puerto and "http" not in _exportadores:
+            _exportadores["http"] = servir_metricas(puerto)
+        if archivo and "archivo" not in _exportadores:
+            def volcar():
+                while True:
+                    time.sleep(intervalo)
+                    escribir_metricas(archivo)
+            _exportadores["archivo"] = threading.Thread(target=volcar, name="bookslives-metricas-archivo", daemon=True)
+            _exportadores["archivo"].start()
+            # Último volcado al salir (p. ej. al terminar pregenera.py)
+            atexit.register(escribir_metricas, archivo)
+    return dict(_exportadores)
@@ -0,0 +1,257 @@
+# Aquí definimos las funciones de lectura y renderizado del PDF que utiliza BooksLives
+
+# Librerias a utilizar
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from io import BytesIO
+from PyPDF2 import PdfReader
+from pdf2image import convert_from_bytes
+from Tools_BooksLives import clean_text
+from Metricas_BooksLives import medir, medido, registrar_cache
+
+#------------------------------------------------------ Configuración del renderizado ----------------------------------------------#
+
+# Resolución por defecto de las páginas renderizadas
+DPI_PAGINA = 150
+# Número de páginas vecinas (antes y después) que se renderizan junto con la página pedida
+PAGINAS_VECINAS = 1
+# Número máximo de páginas renderizadas que se guardan en memoria
+MAX_PAGINAS_CACHE = 32
+# Número máximo de documentos parseados que se mantienen abiertos en el proceso
+MAX_DOCUMENTOS_CACHE = 8
+# Base de datos del índice de búsqueda de texto completo (compartida por todas las sesiones)
+BUSQUEDA_DB = os.getenv("BOOKSLIVES_BUSQUEDA_DB", "bookslives_busqueda.db")
+# Páginas que se indexan por transacción
+PAGINAS_POR_LOTE_INDICE = 25
+
+#------------------------------------------------------ Caché LRU de páginas ------------------------------------------------------#
+
+class CachePaginas:
+    """
+    Caché LRU acotada de páginas renderizadas, con llave (hash del pdf, página, dpi).
+    Es compartida por todas las sesiones del proceso.
+    """
+    def __init__(self, max_paginas: int = MAX_PAGINAS_CACHE):
+        self.max_paginas = max_paginas
+        self._paginas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, llave):
+        with self._lock:
+            imagen = self._paginas.get(llave)
+            if imagen is not None:
+                self._paginas.move_to_end(llave)
+            return imagen
+
+    def put(self, llave, imagen):
+        with self._lock:
+            self._paginas[llave] = imagen
+            self._paginas.move_to_end(llave)
+            while len(self._paginas) > self.max_paginas:
+                self._paginas.popitem(last=False)
+
+    def __contains__(self, llave):
+        with self._lock:
+            return llave in self._paginas
+
+    def __len__(self):
+        with self._lock:
+            return len(self._paginas)
+
+    def clear(self):
+        with self._lock:
+            self._paginas.clear()
+
+
+cache_paginas = CachePaginas()
+
+#------------------------------------------------------ Documento PDF parseado --------------------------------------------------#
+
+class DocumentoPDF:
+    """
+    PDF parseado una sola vez por hash de contenido: número de páginas, hash y texto limpio por página
+    (extraído bajo demanda). Se comparte entre reruns y sesiones.
+    """
+    def __init__(self, pdf_bytes: bytes, pdf_id: str = None):
+        self.pdf_bytes = pdf_bytes
+        self.pdf_id = pdf_id or hashlib.md5(pdf_bytes).hexdigest()
+        with medir("PdfReader", entrada=pdf_bytes):
+            self._reader = PdfReader(BytesIO(pdf_bytes))
+        self.num_pages = len(self._reader.pages)
+        self._textos = [None] * self.num_pages
+        self._lock = threading.Lock()
+
+    def texto(self, page_number: int) -> str:
+        """Texto de la página (empezando en 1) pasado por clean_text."""
+        indice = page_number - 1
+        texto = self._textos[indice]
+        if texto is None:
+            # PdfReader no es seguro entre hilos
+            with self._lock:
+                texto = self._textos[indice]
+                if texto is None:
+                    with medir("extract_text") as tramo:
+                        texto = clean_text(self._reader.pages[indice].extract_text() or "")
+                        tramo.bytes_salida = len(texto.encode("utf-8"))
+                    self._textos[indice] = texto
+        return texto
+
+    def render(self, page_number: int, dpi: int = DPI_PAGINA, vecinas: int = PAGINAS_VECINAS):
+        return render_page(self.pdf_bytes, self.pdf_id, page_number, self.num_pages, dpi=dpi, vecinas=vecinas)
+
+
+_documentos = OrderedDict()   # pdf_id -> DocumentoPDF
+_ids_archivo = {}             # id del archivo subido -> pdf_id
+_lock_documentos = threading.Lock()
+
+#------------------------------------------------------ Definición de funciones------------------------------------------------#
+
+# Función que renderiza sólo la página pedida (y sus vecinas) en lugar del libro completo
+@medido()
+def render_page(pdf_bytes, pdf_id, page_number, num_pages, dpi=DPI_PAGINA, vecinas=PAGINAS_VECINAS, cache=None):
+    """
+    Devuelve la imagen PIL de una página del PDF, renderizando bajo demanda.
+
+    Args:
+        pdf_bytes: Contenido del PDF.
+        pdf_id: Hash del PDF, usado como parte de la llave de la caché.
+        page_number: Página a mostrar (empezando en 1).
+        num_pages: Número total de páginas del PDF.
+        dpi: Resolución del renderizado.
+        vecinas: Páginas anteriores y posteriores que se renderizan en la misma llamada.
+        cache: Caché de páginas a utilizar (por defecto la del proceso).
+
+    Returns:
+        La imagen PIL de la página pedida.
+    """
+    cache = cache_paginas if cache is None else cache
+    llave = (pdf_id, page_number, dpi)
+    imagen = cache.get(llave)
+    if imagen is not None:
+        registrar_cache("hit")
+        return imagen
+    registrar_cache("miss")
+
+    # Sólo se renderiza el rango contiguo de páginas que aún no está en caché
+    inicio = max(1, page_number - vecinas)
+    fin = min(num_pages, page_number + vecinas)
+    faltantes = [p for p in range(inicio, fin + 1) if p == page_number or (pdf_id, p, dpi) not in cache]
+    primera, ultima = min(faltantes), max(faltantes)
+
+    with medir("convert_from_bytes", entrada=pdf_bytes) as tramo:
+        paginas = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=primera, last_page=ultima)
+        # Tamaño de las páginas decodificadas en memoria
+        tramo.bytes_salida = sum(pagina.width * pagina.height * len(pagina.getbands()) for pagina in paginas)
+    for offset, pagina in enumerate(paginas):
+        numero = primera + offset
+        if numero == page_number:
+            imagen = pagina
+        cache.put((pdf_id, numero, dpi), pagina)
+
+    return imagen
+
+# Función que devuelve el documento parseado para unos bytes de PDF (se parsea una vez por hash)
+def cargar_documento(pdf_bytes, pdf_id=None):
+    pdf_id = pdf_id or hashlib.md5(pdf_bytes).hexdigest()
+    with _lock_documentos:
+        documento = _documentos.get(pdf_id)
+        if documento is not None:
+            _documentos.move_to_end(pdf_id)
+            return documento
+    documento = DocumentoPDF(pdf_bytes, pdf_id)
+    with _lock_documentos:
+        documento = _documentos.setdefault(pdf_id, documento)
+        _documentos.move_to_end(pdf_id)
+        while len(_documentos) > MAX_DOCUMENTOS_CACHE:
+            _documentos.popitem(last=False)
+    return documento
+
+# Función que obtiene el documento de un archivo subido en Streamlit sin releer ni re-hashear sus bytes en cada rerun
+def documento_desde_archivo(uploaded_file):
+    file_id = getattr(uploaded_file, "file_id", None)
+    if file_id is not None:
+        with _lock_documentos:
+            pdf_id = _ids_archivo.get(file_id)
+            documento = _documentos.get(pdf_id) if pdf_id else None
+        if documento is not None:
+            return documento
+    documento = cargar_documento(uploaded_file.getvalue())
+    if file_id is not None:
+        with _lock_documentos:
+            _ids_archivo[file_id] = documento.pdf_id
+    return documento
+
+#------------------------------------------------------ Búsqueda de texto completo -------------------------------------------#
+
+class IndiceBusqueda:
+    """
+    Índice SQLite FTS5 con el texto limpio de cada página, por hash del pdf. Se construye por lotes en segundo plano
+    (reanudable: continúa desde la última página indexada) y lo reutilizan todas las sesiones.
+    """
+    def __init__(self, ruta=BUSQUEDA_DB):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._hilos = {}
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS paginas USING fts5("
+            "pdf_id UNINDEXED, pagina UNINDEXED, texto, tokenize='unicode61 remove_diacritics 2')"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS libros (pdf_id TEXT PRIMARY KEY, indexadas INTEGER NOT NULL, total INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    def avance(self, pdf_id):
+        """Devuelve (páginas indexadas, total) del libro."""
+        with self._lock:
+            fila = self._conn.execute("SELECT indexadas, total FROM libros WHERE pdf_id = ?", (pdf_id,)).fetchone()
+        return fila if fila else (0, 0)
+
+    @medido("indexar_busqueda")
+    def indexar(self, documento):
+        indexadas, _ = self.avance(documento.pdf_id)
+        for inicio in range(indexadas + 1, documento.num_pages + 1, PAGINAS_POR_LOTE_INDICE):
+            fin = min(documento.num_pages, inicio + PAGINAS_POR_LOTE_INDICE - 1)
+            filas = [(documento.pdf_id, p, documento.texto(p)) for p in range(inicio, fin + 1)]
+            with self._lock:
+                self._conn.executemany("INSERT INTO paginas (pdf_id, pagina, texto) VALUES (?, ?, ?)", filas)
+                self._conn.execute(
+                    "INSERT INTO libros (pdf_id, indexadas, total) VALUES (?, ?, ?) "
+                    "ON CONFLICT (pdf_id) DO UPDATE SET indexadas = excluded.indexadas, total = excluded.total",
+                    (documento.pdf_id, fin, documento.num_pages),
+                )
+                self._conn.commit()
+
+    def indexar_en_segundo_plano(self, documento):
+        """Lanza la indexación del libro si no está completa ni en curso."""
+        indexadas, _ = self.avance(documento.pdf_id)
+        if indexadas >= documento.num_pages:
+            return
+        with self._lock:
+            hilo = self._hilos.get(documento.pdf_id)
+            if hilo is not None and hilo.is_alive():
+                return
+            hilo = threading.Thread(target=self.indexar, args=(documento,), name="bookslives-indice", daemon=True)
+            self._hilos[documento.pdf_id] = hilo
+            hilo.start()
+
+    @medido("buscar")
+    def buscar(self, pdf_id, consulta, limite=20):
+        """Devuelve [(página, fragmento)] ordenados por relevancia; los términos encontrados van en **negrita**."""
+        # Cada palabra se busca como término literal para que la sintaxis de FTS5 no rompa la consulta
+        terminos = re.findall(r"\w+", consulta)
+        if not terminos:
+            return []
+        expresion = " ".join(f'"{termino}"' for termino in terminos)
+        with self._lock:
+            return self._conn.execute(
+                "SELECT pagina, snippet(paginas, 2, '**', '**', '…', 12) FROM paginas "
+                "WHERE paginas MATCH ? AND pdf_id = ? ORDER BY rank LIMIT ?",
+                (expresion, pdf_id, limite),
+            ).fetchall()
@@ -0,0 +1,119 @@
+# Aquí definimos el almacén del avance de lectura de BooksLives (página guardada por usuario y libro)
+
+# Librerias a utilizar
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+#------------------------------------------------------ Configuración del progreso ----------------------------------------------#
+
+# Base de datos del progreso y archivo JSON antiguo que se migra la primera vez
+PROGRESS_DB = os.getenv("BOOKSLIVES_PROGRESS_DB", "pdf_progress.db")
+PROGRESS_FILE = "pdf_progress.json"
+# Cada cuántos segundos se escriben en disco las páginas pendientes
+PROGRESS_FLUSH_SEGUNDOS = float(os.getenv("BOOKSLIVES_PROGRESS_FLUSH_SEGUNDOS", "2"))
+# Usuario con el progreso migrado del JSON y la última página de cada libro que leyó un lector anónimo
+# (punto de partida para un lector anónimo que abre el libro por primera vez)
+USUARIO_PUBLICO = "publico"
+# Prefijo de los ids de lectores anónimos y días sin leer tras los que se borra su progreso (0 = nunca)
+PREFIJO_ANONIMO = "anonimo-"
+PROGRESS_ANONIMO_DIAS = float(os.getenv("BOOKSLIVES_PROGRESS_ANONIMO_DIAS", "90"))
+
+#------------------------------------------------------ Almacén de progreso ---------------------------------------------------#
+
+class AlmacenProgreso:
+    """
+    Progreso de lectura con llave (usuario, hash del pdf) en SQLite (modo WAL).
+    Las escrituras pasan por un pequeño buffer en memoria que un hilo vuelca con upserts por llave,
+    así que cada clic cuesta O(1) y no se pierden actualizaciones entre lectores concurrentes.
+    """
+    def __init__(self, ruta=PROGRESS_DB, intervalo=PROGRESS_FLUSH_SEGUNDOS, legado=PROGRESS_FILE, dias_anonimos=PROGRESS_ANONIMO_DIAS):
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self._pendientes = {}   # (usuario, pdf_id) -> página
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS progreso (
+                usuario TEXT NOT NULL,
+                pdf_id TEXT NOT NULL,
+                pagina INTEGER NOT NULL,
+                actualizado REAL NOT NULL,
+                PRIMARY KEY (usuario, pdf_id)
+            )"""
+        )
+        self._conn.commit()
+        self._migrar(legado)
+        if dias_anonimos > 0:
+            self.podar_anonimos(dias_anonimos)
+
+        self._evento = threading.Event()
+        self._hilo = threading.Thread(target=self._volcar_periodicamente, name="bookslives-progreso", daemon=True)
+        self._hilo.start()
+        atexit.register(self.close)
+
+    def _migrar(self, legado):
+        # Importa una sola vez el JSON antiguo (pdf_id -> página) como progreso público
+        if not legado or not os.path.exists(legado):
+            return
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM progreso LIMIT 1").fetchone() is not None:
+                return
+            with open(legado, "r") as f:
+                progress = json.load(f)
+            ahora = time.time()
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO progreso (usuario, pdf_id, pagina, actualizado) VALUES (?, ?, ?, ?)",
+                [(USUARIO_PUBLICO, pdf_id, int(pagina), ahora) for pdf_id, pagina in progress.items()],
+            )
+            self._conn.commit()
+
+    def podar_anonimos(self, dias):
+        """Borra el progreso de los lectores anónimos que llevan más de `dias` sin leer; devuelve las filas borradas."""
+        limite = time.time() - dias * 86400
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM progreso WHERE usuario LIKE ? AND actualizado < ?", (f"{PREFIJO_ANONIMO}%", limite)
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def get(self, usuario, pdf_id):
+        """Página guardada para (usuario, pdf) o None."""
+        with self._lock:
+            pagina = self._pendientes.get((usuario, pdf_id))
+            if pagina is not None:
+                return pagina
+            fila = self._conn.execute(
+                "SELECT pagina FROM progreso WHERE usuario = ? AND pdf_id = ?", (usuario, pdf_id)
+            ).fetchone()
+        return fila[0] if fila else None
+
+    def set(self, usuario, pdf_id, pagina):
+        with self._lock:
+            self._pendientes[(usuario, pdf_id)] = int(pagina)
+
+    def flush(self):
+        with self._lock:
+            if not self._pendientes:
+                return
+            pendientes, self._pendientes = self._pendientes, {}
+            ahora = time.time()
+            self._conn.executemany(
+                """INSERT INTO progreso (usuario, pdf_id, pagina, actualizado) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (usuario, pdf_id) DO UPDATE SET pagina = excluded.pagina, actualizado = excluded.actualizado""",
+                [(usuario, pdf_id, pagina, ahora) for (usuario, pdf_id), pagina in pendientes.items()],
+            )
+            self._conn.commit()
+
+    def _volcar_periodicamente(self):
+        while not self._evento.wait(self.intervalo):
+            self.flush()
+
+    def close(self):
+        self._evento.set()
+        self.flush()
@@ -1,31 +1,70 @@
 # Aquí vamos a definir las funciones que vamos a utilizar en la arquitectura de nuestra BooksLives
 
 # Librerias a utilizar
-from transformers import pipeline
-import scipy
+# Las librerías pesadas (transformers/torch, openai, replicate, requests) y los clientes de las APIs se cargan
+# la primera vez que se usan, para que importar este módulo sea casi instantáneo.
 import numpy as np 
-from openai import OpenAI
 import json
 import re
 from io import BytesIO
 import os
-import requests
 from typing import List, Optional
 from pydantic import BaseModel, Field
-import replicate
+import threading
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Cache_BooksLives import almacenado, almacen, bloqueo_archivo, configurar_limites, CacheSemantica, CACHE_DIR
+from Metricas_BooksLives import medido, registrar_tokens, con_contexto
 
 #------------------------------------------------------ Conexión a APIS ----------------------------------------------------------#
 # Variables de entorno
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 
-#Conexion ChatGPT
+_clientes = {}
+_lock_clientes = threading.Lock()
 
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-client = OpenAI()
+# Función que devuelve el cliente de OpenAI (se crea en el primer uso)
+def get_client():
+    if "openai" not in _clientes:
+        with _lock_clientes:
+            if "openai" not in _clientes:
+                #Conexion ChatGPT
+                from openai import OpenAI
+                _clientes["openai"] = OpenAI(api_key=OPENAI_API_KEY)
+    return _clientes["openai"]
+
+# Función que devuelve el cliente de Replicate (se crea en el primer uso)
+def get_client_replicate():
+    if "replicate" not in _clientes:
+        with _lock_clientes:
+            if "replicate" not in _clientes:
+                # Conexión a Replicate
+                import replicate
+                _clientes["replicate"] = replicate.Client(REPLICATE_API_TOKEN)
+    return _clientes["replicate"]
+
+# Función que reemplaza los clientes de las APIs (p. ej. por clientes que apuntan a servidores locales en el benchmark)
+def configurar_clientes(openai=None, replicate=None):
+    with _lock_clientes:
+        if openai is not None:
+            _clientes["openai"] = openai
+        if replicate is not None:
+            _clientes["replicate"] = replicate
+
+# Compatibilidad: `Tools_BooksLives.client` y `client_replicate` siguen disponibles, pero se crean al pedirlos
+def __getattr__(nombre):
+    if nombre == "client":
+        return get_client()
+    if nombre == "client_replicate":
+        return get_client_replicate()
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
+# Función que carga transformers.pipeline sólo cuando se necesita un modelo local
+def pipeline(*args, **kwargs):
+    from transformers import pipeline as transformers_pipeline
+    return transformers_pipeline(*args, **kwargs)
 
-# Conexión a Replicate
-client_replicate = replicate.Client(REPLICATE_API_TOKEN)
 #------------------------------------------------------- Ingeniería de Prompt ---------------------------------------------------#
 
 # Prompt para la generación de instrucciones de música (MusicGen)
@@ -55,20 +94,166 @@ Sigue estas reglas:
 #------------------------------------------------------ Definición de funciones------------------------------------------------#
 
 # Función que genera el prompt para generar la música
-def text_to_music(texto):   
-    respuesta = client.chat.completions.create(
+def text_to_music(texto):
+    # En modo combinado es una vista sobre el análisis de página (una sola llamada al LLM)
+    if ANALISIS_COMBINADO:
+        return analisis_pagina(get_client(), texto)["prompt_musica"]
+    return text_to_music_individual(texto)
+
+@almacenado("text_to_music", modelo="gpt-5", version=prompt_instruccion_genera_musica, backend="openai")
+def text_to_music_individual(texto):
+    respuesta = get_client().chat.completions.create(
         model="gpt-5",
         messages=[
             {"role": "system", "content": prompt_instruccion_genera_musica},
             {"role": "user", "content": texto}
         ]
     )
+    registrar_tokens(respuesta)
     return respuesta.choices[0].message.content.strip()
 
-# Función genera música
-def musicgen_generation(prompt_from_text):
-    # Carga del modelo small para mayor velocidad
-    synthesiser = pipeline("text-to-audio", "facebook/musicgen-small")
+#------------------------------------------------------ Modelo MusicGen (una carga por proceso) ------------------------------------#
+
+# Configuración del modelo (por variables de entorno para poder ajustarla en cada despliegue)
+MUSICGEN_MODEL = os.getenv("MUSICGEN_MODEL", "facebook/musicgen-small")
+MUSICGEN_THREADS = int(os.getenv("MUSICGEN_THREADS", "0"))          # 0 = valor por defecto de torch
+MUSICGEN_DTYPE = os.getenv("MUSICGEN_DTYPE", "float32")             # float32 / bfloat16 / float16
+MUSICGEN_QUANTIZE = os.getenv("MUSICGEN_QUANTIZE", "0") == "1"      # cuantización dinámica int8 en CPU
+MUSICGEN_WARMUP = os.getenv("MUSICGEN_WARMUP", "0") == "1"          # generación corta al arrancar
+MUSICGEN_WORKER = os.getenv("MUSICGEN_WORKER", "0") == "1"          # generar en un proceso trabajador aparte
+MUSICGEN_TIMEOUT = float(os.getenv("MUSICGEN_TIMEOUT", "600"))      # segundos máximos de espera al trabajador
+
+if MUSICGEN_WORKER:
+    # El trabajador agrupa los trabajos en lotes, así que se le envían tantos a la vez como su tamaño de lote
+    from Worker_BooksLives import MUSICGEN_BATCH
+    configurar_limites(musicgen=MUSICGEN_BATCH)
+
+class ModeloMusicGen:
+    """
+    Contenedor del pipeline de MusicGen: se carga de forma perezosa una sola vez por proceso y se reutiliza
+    en todas las generaciones.
+    """
+    def __init__(self, model_name=MUSICGEN_MODEL, threads=MUSICGEN_THREADS, dtype=MUSICGEN_DTYPE, quantize=MUSICGEN_QUANTIZE):
+        self.model_name = model_name
+        self.threads = threads
+        self.dtype = dtype
+        self.quantize = quantize
+        self._synthesiser = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._synthesiser is None:
+            with self._lock:
+                if self._synthesiser is None:
+                    self._synthesiser = self._cargar()
+        return self._synthesiser
+
+    def _cargar(self):
+        import torch
+
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+
+        synthesiser = pipeline("text-to-audio", self.model_name, torch_dtype=getattr(torch, self.dtype))
+
+        # Variante cuantizada (sólo tiene sentido en CPU)
+        if self.quantize and synthesiser.device.type == "cpu":
+            synthesiser.model = torch.ao.quantization.quantize_dynamic(
+                synthesiser.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        synthesiser.model.eval()
+        return synthesiser
+
+    def procesador(self):
+        """Procesador de MusicGen (texto + audio de contexto), necesario para la generación por continuación."""
+        if getattr(self, "_procesador", None) is None:
+            from transformers import AutoProcessor
+            with self._lock:
+                if getattr(self, "_procesador", None) is None:
+                    self._procesador = AutoProcessor.from_pretrained(self.model_name)
+        return self._procesador
+
+    def warmup(self, prompt="calm ambient piano", max_new_tokens=16):
+        """Carga el modelo y hace una generación corta para que la primera petición real no pague la inicialización."""
+        synthesiser = self.get()
+        synthesiser(prompt, forward_params={"do_sample": True, "max_new_tokens": max_new_tokens})
+        return synthesiser
+
+
+modelo_musicgen = ModeloMusicGen()
+
+#------------------------------------------------------ Codificación de audio ------------------------------------------------#
+
+# Formato de la música: "wav" (sin compresión), "ogg" (Vorbis) o "mp3". Los comprimidos requieren soundfile (libsndfile)
+AUDIO_FORMATO = os.getenv("BOOKSLIVES_AUDIO_FORMATO", "ogg")
+# Nivel de compresión de libsndfile entre 0.0 (mayor bitrate) y 1.0 (menor bitrate)
+AUDIO_COMPRESION = float(os.getenv("BOOKSLIVES_AUDIO_COMPRESION", "0.5"))
+MIME_AUDIO = {"wav": "audio/wav", "ogg": "audio/ogg", "mp3": "audio/mpeg"}
+_SOUNDFILE_FORMATOS = {"ogg": ("OGG", "VORBIS"), "mp3": ("MP3", "MPEG_LAYER_III")}
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+if AUDIO_FORMATO != "wav" and soundfile is None:
+    # Sin libsndfile no se puede comprimir: se sirve WAV
+    AUDIO_FORMATO = "wav"
+MIME_MUSICA = MIME_AUDIO[AUDIO_FORMATO]
+
+# Función que prepara el audio float de MusicGen: forma (muestras,) o (muestras, canales), escalado y recortado en sitio
+def _pcm_en_sitio(audio_data_float):
+    audio = np.asarray(audio_data_float, dtype=np.float32)
+    if audio.ndim == 2 and audio.shape[0] < audio.shape[1]:
+        audio = audio.T
+    if audio.ndim == 2 and audio.shape[1] == 1:
+        audio = audio[:, 0]
+    # Escalar a int16 sin crear arrays intermedios (el array de entrada se modifica)
+    np.multiply(audio, 32767, out=audio)
+    np.clip(audio, -32768, 32767, out=audio)
+    return audio
+
+# Función que escribe un WAV PCM de 16 bits directamente en un único buffer (cabecera + muestras, sin copias extra)
+def _wav_pcm16(audio_escalado, sampling_rate):
+    canales = 1 if audio_escalado.ndim == 1 else audio_escalado.shape[1]
+    n_datos = audio_escalado.size * 2
+    buffer = bytearray(44 + n_datos)
+    buffer[:44] = b"".join([
+        b"RIFF", (36 + n_datos).to_bytes(4, "little"), b"WAVE",
+        b"fmt ", (16).to_bytes(4, "little"), (1).to_bytes(2, "little"), canales.to_bytes(2, "little"),
+        int(sampling_rate).to_bytes(4, "little"), (int(sampling_rate) * canales * 2).to_bytes(4, "little"),
+        (canales * 2).to_bytes(2, "little"), (16).to_bytes(2, "little"),
+        b"data", n_datos.to_bytes(4, "little"),
+    ])
+    # Conversión float -> int16 escrita directamente sobre el buffer de salida
+    np.frombuffer(buffer, dtype=np.int16, offset=44).reshape(audio_escalado.shape)[...] = audio_escalado
+    return memoryview(buffer)
+
+# Función que codifica el audio float de MusicGen en el formato configurado y devuelve un memoryview (sin copias)
+@medido()
+def codificar_audio(audio_data_float, sampling_rate, formato=None, compresion=AUDIO_COMPRESION):
+    formato = formato or AUDIO_FORMATO
+    if formato == "wav":
+        return _wav_pcm16(_pcm_en_sitio(audio_data_float), sampling_rate)
+    audio = np.asarray(audio_data_float, dtype=np.float32)
+    if audio.ndim == 2 and audio.shape[0] < audio.shape[1]:
+        audio = audio.T
+    formato_sf, subtipo = _SOUNDFILE_FORMATOS[formato]
+    salida = BytesIO()
+    soundfile.write(salida, audio, int(sampling_rate), format=formato_sf, subtype=subtipo, compression_level=compresion)
+    return salida.getbuffer()
+
+# Función genera música; `mood` se añade al prompt pero no forma parte de la llave (ver prompt_con_mood)
+@almacenado("musicgen_generation", modelo=MUSICGEN_MODEL, version=f"max_new_tokens=512;{AUDIO_FORMATO}", backend="musicgen", ignorar=("mood",))
+def musicgen_generation(prompt_from_text, mood=None):
+    prompt_from_text = prompt_con_mood(prompt_from_text, mood)
+    # Fuera del proceso de Streamlit: el trabajador agrupa los prompts pendientes en lotes
+    if MUSICGEN_WORKER:
+        from Worker_BooksLives import cliente_musicgen
+        # Con tiempo límite: si el trabajador se cuelga, la llamada no retiene para siempre el semáforo de musicgen
+        return cliente_musicgen.generar(prompt_from_text, max_new_tokens=512, timeout=MUSICGEN_TIMEOUT)
+
+    # Modelo cargado una sola vez por proceso
+    synthesiser = modelo_musicgen.get()
 
     music = synthesiser(
         prompt_from_text,
@@ -78,24 +263,156 @@ def musicgen_generation(prompt_from_text):
         }
     )
     
-    # Escalar y convertir a int16 para evitar distorsión de volumen
-    audio_data_float = music["audio"]
-    audio_data_int = (audio_data_float * 32767).astype(np.int16)
+    return codificar_audio(music["audio"], music["sampling_rate"])
+
+#------------------------------------------------------ Música larga por segmentos --------------------------------------------#
+
+# Duración de la música en modo largo (0 = clip clásico de ~10 segundos que se repite en bucle)
+MUSICA_DURACION = float(os.getenv("BOOKSLIVES_MUSICA_DURACION", "0"))
+MUSICA_SEGMENTO = float(os.getenv("BOOKSLIVES_MUSICA_SEGMENTO", "10"))   # segundos nuevos por segmento
+MUSICA_CONTEXTO = 3.0                                                   # segundos del final previo usados como condición
+MUSICA_SOLAPE = 1.0                                                     # segundos de fundido cruzado entre segmentos
+
+# Función que funde dos tramos de audio de igual longitud con un fundido de igual potencia
+@medido()
+def crossfade(final_anterior, inicio_siguiente):
+    t = np.linspace(0.0, np.pi / 2, len(final_anterior), dtype=np.float32)
+    return final_anterior * np.cos(t) + inicio_siguiente * np.sin(t)
+
+# Función que genera música de la duración pedida en segmentos de tamaño fijo, cada uno condicionado por el final
+# del anterior. Entrega tramos float32 listos para concatenar; sólo guarda en memoria el contexto y el solape.
+def musicgen_streaming(prompt_from_text, duracion=60.0, segmento=MUSICA_SEGMENTO, contexto=MUSICA_CONTEXTO, solape=MUSICA_SOLAPE):
+    synthesiser = modelo_musicgen.get()
+    model = synthesiser.model
+    processor = modelo_musicgen.procesador()
+    sampling_rate = model.config.audio_encoder.sampling_rate
+    tokens_segmento = int(segmento * model.config.audio_encoder.frame_rate)
+    n_solape = int(solape * sampling_rate)
+    n_contexto = int(contexto * sampling_rate)
+
+    generado = 0.0
+    cola = None   # final del segmento anterior: contexto para el siguiente
+    pendiente = None   # solape retenido del segmento anterior para el fundido
+    while generado < duracion:
+        if cola is None:
+            inputs = processor(text=[prompt_from_text], padding=True, return_tensors="pt")
+        else:
+            inputs = processor(audio=cola, sampling_rate=sampling_rate, text=[prompt_from_text], padding=True, return_tensors="pt")
+        audio = model.generate(**inputs, do_sample=True, max_new_tokens=tokens_segmento)[0, 0].cpu().numpy().astype(np.float32)
+
+        if cola is not None:
+            # La salida incluye el audio de contexto: se descarta salvo los últimos `n_solape` para el fundido
+            audio = audio[len(cola) - n_solape:]
+            audio[:n_solape] = crossfade(pendiente, audio[:n_solape])
+        generado += segmento
 
-    audio_bytes = BytesIO()
-    scipy.io.wavfile.write(audio_bytes, music["sampling_rate"], audio_data_int)
+        if generado >= duracion:
+            yield audio
+            break
+        # El solape del final se retiene hasta fundirlo con el siguiente segmento
+        pendiente = audio[-n_solape:].copy()
+        cola = audio[-n_contexto:].copy()
+        yield audio[:-n_solape]
 
-    return audio_bytes.getvalue()
+# Función genera música larga sin costuras; `al_segmento` recibe cada tramo en cuanto está listo
+@almacenado("musica_larga", modelo=MUSICGEN_MODEL, version=f"segmento={MUSICA_SEGMENTO};{AUDIO_FORMATO}", backend="musicgen", ignorar=("al_segmento", "mood"))
+def musica_larga(prompt_from_text, duracion=60.0, al_segmento=None, mood=None):
+    prompt_from_text = prompt_con_mood(prompt_from_text, mood)
+    sampling_rate = modelo_musicgen.get().model.config.audio_encoder.sampling_rate
+    tramos = []
+    for tramo in musicgen_streaming(prompt_from_text, duracion=duracion):
+        tramos.append(tramo)
+        if al_segmento is not None:
+            # Se codifica una copia: la codificación escala el audio en sitio
+            al_segmento(bytes(codificar_audio(tramo.copy(), sampling_rate)))
+    return codificar_audio(np.concatenate(tramos), sampling_rate)
 
 # Función que limpia texto
+@medido()
 def clean_text(texto):
     patron = r"www\.lectulandia\.com\s-\sPágina\s\d+"
     texto_limpio=re.sub(patron, "", texto)
     texto_limpio= re.sub(r"\n\s*\n", "\n", texto_limpio).strip()
     return texto_limpio
 
-# Función Analisis de emociones y topicos texto
-def vector_sentimientos(texto):
+#------------------------------------------------------ Análisis de emociones ------------------------------------------------#
+
+# Emociones que devuelve cualquier backend de sentimientos
+EMOCIONES = ("alegria", "tristeza", "miedo", "enojo", "sorpresa", "neutralidad")
+
+# Backend de sentimientos: "llm" (gpt-5-mini) o "local" (clasificador de emociones en español con transformers)
+SENTIMIENTO_BACKEND = os.getenv("BOOKSLIVES_SENTIMIENTO_BACKEND", "llm")
+SENTIMIENTO_MODEL = os.getenv("BOOKSLIVES_SENTIMIENTO_MODEL", "pysentimiento/robertuito-emotion-analysis")
+SENTIMIENTO_BATCH = int(os.getenv("BOOKSLIVES_SENTIMIENTO_BATCH", "32"))
+# Caracteres por fragmento: el modelo sólo ve 128 tokens, así que la página se puntúa por fragmentos y se promedia
+SENTIMIENTO_MAX_CARACTERES = 400
+
+# Etiquetas del modelo local -> emociones de BooksLives
+ETIQUETAS_EMOCION = {
+    "joy": "alegria", "sadness": "tristeza", "fear": "miedo", "anger": "enojo", "disgust": "enojo",
+    "surprise": "sorpresa", "others": "neutralidad", "neutral": "neutralidad",
+}
+
+class ClasificadorEmociones:
+    """Clasificador local de emociones: se carga una sola vez por proceso y puntúa muchos textos en lotes."""
+    def __init__(self, model_name=SENTIMIENTO_MODEL, batch_size=SENTIMIENTO_BATCH):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._clasificador = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._clasificador is None:
+            with self._lock:
+                if self._clasificador is None:
+                    self._clasificador = pipeline("text-classification", self.model_name, top_k=None, truncation=True)
+        return self._clasificador
+
+    def puntuar(self, textos):
+        """Devuelve un diccionario con las seis emociones por cada texto, con una sola pasada por lotes."""
+        fragmentos, duenos = [], []
+        for i, texto in enumerate(textos):
+            for fragmento in dividir_texto(texto, SENTIMIENTO_MAX_CARACTERES):
+                fragmentos.append(fragmento)
+                duenos.append(i)
+
+        pesos = np.zeros((len(textos), len(EMOCIONES)))
+        if fragmentos:
+            salidas = self.get()(fragmentos, batch_size=self.batch_size)
+            for fragmento, dueno, etiquetas in zip(fragmentos, duenos, salidas):
+                # Cada fragmento pesa según su longitud
+                for etiqueta in etiquetas:
+                    emocion = ETIQUETAS_EMOCION.get(etiqueta["label"].lower(), "neutralidad")
+                    pesos[dueno, EMOCIONES.index(emocion)] += etiqueta["score"] * len(fragmento)
+
+        vectores = []
+        for fila in pesos:
+            total = fila.sum()
+            fila = fila / total if total > 0 else np.eye(len(EMOCIONES))[EMOCIONES.index("neutralidad")]
+            vectores.append({emocion: round(float(valor), 3) for emocion, valor in zip(EMOCIONES, fila)})
+        return vectores
+
+
+clasificador_emociones = ClasificadorEmociones()
+
+# Función que puntúa una sola página con el modelo local (la llave del almacén es la misma que usa el lote)
+@almacenado("vector_sentimientos_local", modelo=SENTIMIENTO_MODEL)
+def vector_sentimientos_local(texto):
+    return clasificador_emociones.puntuar([texto])[0]
+
+# Función que devuelve el JSON del LLM aunque venga rodeado de texto
+def _parse_json(contenido):
+    try:
+        return json.loads(contenido)
+    except json.JSONDecodeError:
+        coincidencia = re.search(r"\{.*\}", contenido, re.DOTALL)
+        if coincidencia is None:
+            raise
+        return json.loads(coincidencia.group(0))
+
+# Función Analisis de emociones y topicos texto (backend LLM)
+@almacenado("vector_sentimientos", modelo="gpt-5-mini", version="v1", backend="openai")
+def vector_sentimientos_llm(texto):
     prompt = f"""
     Analiza el siguiente TEXTO y devuelve un objeto JSON con puntajes numéricos entre 0.0 y 1.0 (inclusive) para cada emoción. Los puntajes deben sumar aproximadamente 1.0 (±0.05). Redondea a tres decimales y muestralos en formato de porcentaje.
     
@@ -110,13 +427,44 @@ def vector_sentimientos(texto):
     Texto:
     "{texto}"
     """
-    respuesta = client.chat.completions.create(
+    respuesta = get_client().chat.completions.create(
         model="gpt-5-mini",
         messages=[{"role": "system", "content": "Eres un analizador de emociones preciso y estricto. Responde únicamente con JSON válido que siga exactamente el esquema indicado. No agregues explicaciones ni texto fuera del JSON."},
                   {"role": "user", "content": prompt}],
     )
+    registrar_tokens(respuesta)
     
-    return json.loads(respuesta.choices[0].message.content)
+    return _parse_json(respuesta.choices[0].message.content)
+
+# Función Analisis de emociones: usa el backend configurado y devuelve siempre las seis emociones
+def vector_sentimientos(texto, backend=None):
+    return vector_sentimientos_lote([texto], backend=backend)[0]
+
+# Función que puntúa muchas páginas a la vez; con el backend local sólo las que no están en el almacén pasan por el modelo
+@medido()
+def vector_sentimientos_lote(textos, backend=None):
+    backend = backend or SENTIMIENTO_BACKEND
+    if backend == "llm":
+        if ANALISIS_COMBINADO:
+            return [analisis_pagina(get_client(), texto)["emociones"] for texto in textos]
+        return [vector_sentimientos_llm(texto) for texto in textos]
+    if backend != "local":
+        raise ValueError(f"Backend de sentimientos desconocido: {backend}")
+
+    resultados = [None] * len(textos)
+    pendientes = []
+    for i, texto in enumerate(textos):
+        encontrado, valor = almacen.get(vector_sentimientos_local.llave(texto), "vector_sentimientos_local")
+        if encontrado:
+            resultados[i] = valor
+        else:
+            pendientes.append(i)
+    if pendientes:
+        nuevos = clasificador_emociones.puntuar([textos[i] for i in pendientes])
+        for i, valor in zip(pendientes, nuevos):
+            almacen.put(vector_sentimientos_local.llave(textos[i]), valor, "vector_sentimientos_local")
+            resultados[i] = valor
+    return resultados
 
 
 #------------------------------------------------------ Definición de funciones nuevas-----------------------------------------#
@@ -151,6 +499,12 @@ def get_book_insights(client, book_text: str, model_name: str = "gpt-5-mini") ->
     Returns:
         Un objeto diccionario derivado de BookInsights con los insights extraídos.
     """
+    if ANALISIS_COMBINADO:
+        return analisis_pagina(client, book_text)["insights"]
+    return get_book_insights_individual(client, book_text, model_name=model_name)
+
+@almacenado("get_book_insights", version=BookInsights.model_json_schema(), backend="openai")
+def get_book_insights_individual(client, book_text: str, model_name: str = "gpt-5-mini"):
     response = client.chat.completions.parse(
         model=model_name,
         messages=[
@@ -159,25 +513,715 @@ def get_book_insights(client, book_text: str, model_name: str = "gpt-5-mini") ->
         ],
         response_format=BookInsights,
     )
+    registrar_tokens(response)
     insights = response.choices[0].message.parsed
     return insights.model_dump()
 
 
+#------------------------------------------------------ Análisis combinado de página ------------------------------------------#
+
+# Si está activo, el prompt musical, las emociones, los insights y el prompt de imagen salen de una sola llamada al LLM
+ANALISIS_COMBINADO = os.getenv("BOOKSLIVES_ANALISIS_COMBINADO", "0") == "1"
+ANALISIS_MODEL = os.getenv("BOOKSLIVES_ANALISIS_MODEL", "gpt-5-mini")
+
+class EmocionesPagina(BaseModel):
+    """
+    Puntajes entre 0.0 y 1.0 de cada emoción del texto; deben sumar aproximadamente 1.0.
+    """
+    alegria: float = Field(description="Puntaje de alegría entre 0.0 y 1.0")
+    tristeza: float = Field(description="Puntaje de tristeza entre 0.0 y 1.0")
+    miedo: float = Field(description="Puntaje de miedo entre 0.0 y 1.0")
+    enojo: float = Field(description="Puntaje de enojo entre 0.0 y 1.0")
+    sorpresa: float = Field(description="Puntaje de sorpresa entre 0.0 y 1.0")
+    neutralidad: float = Field(description="Puntaje de neutralidad entre 0.0 y 1.0")
+
+class AnalisisPagina(BaseModel):
+    """
+    Output estructurado con todo el análisis de una página en una sola respuesta.
+    """
+    prompt_musica: str = Field(description="Prompt en inglés para MusicGen, máximo 15 palabras, con términos musicales descriptivos")
+    emociones: EmocionesPagina = Field(description="Vector de emociones del texto")
+    insights: BookInsights = Field(description="Insights clave del fragmento, en español")
+    prompt_imagen: str = Field(description="Prompt visual y cinematográfico de 2 a 4 líneas para un modelo de imagen")
+
+prompt_analisis_pagina = f"""Eres un experto Analista de libros y novelas. Recibirás un fragmento de un libro y devolverás SOLO un JSON
+válido que siga exactamente el esquema de AnalisisPagina. Cada campo sigue estas instrucciones:
+
+prompt_musica:
+{prompt_instruccion_genera_musica}
+
+emociones: puntajes numéricos entre 0.0 y 1.0 para cada emoción, que sumen aproximadamente 1.0 (±0.05), redondeados a tres decimales.
+
+insights: insights clave del fragmento siguiendo el esquema de BookInsights. Salidas en español.
+
+prompt_imagen:
+{prompt_text_imagen}"""
+
+# Función que hace el análisis completo de una página en una sola llamada (structured output)
+@almacenado("analisis_pagina", version=prompt_analisis_pagina, backend="openai")
+def analisis_pagina(client, texto: str, model_name: str = ANALISIS_MODEL) -> dict:
+    """
+    Obtiene el prompt musical, las emociones, los insights y el prompt de imagen de un fragmento de texto
+    con una sola llamada a OpenAI, en lugar de cuatro que reenvían el mismo texto.
+
+    Args:
+        client: Cliente de OpenAI inicializado.
+        texto: El texto del fragmento del libro.
+        model_name: El nombre del modelo de OpenAI a utilizar.
+
+    Returns:
+        Un diccionario derivado de AnalisisPagina.
+    """
+    response = client.chat.completions.parse(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": prompt_analisis_pagina},
+            {"role": "user", "content": texto},
+        ],
+        response_format=AnalisisPagina,
+    )
+    registrar_tokens(response)
+    analisis = response.choices[0].message.parsed.model_dump()
+    analisis["prompt_musica"] = analisis["prompt_musica"].strip()
+    analisis["prompt_imagen"] = analisis["prompt_imagen"].strip()
+    return analisis
+
+
 # Función que genera el prompt para generar la imagen
 def text_to_imagen(texto):
-    respuesta = client.chat.completions.create(
+    if ANALISIS_COMBINADO:
+        return analisis_pagina(get_client(), texto)["prompt_imagen"]
+    return text_to_imagen_individual(texto)
+
+@almacenado("text_to_imagen", modelo="gpt-5-mini", version=prompt_text_imagen, backend="openai")
+def text_to_imagen_individual(texto):
+    respuesta = get_client().chat.completions.create(
         model="gpt-5-mini",
         messages=[
             {"role": "system", "content": prompt_text_imagen},
             {"role": "user", "content": texto}
         ]
     )
+    registrar_tokens(respuesta)
     return respuesta.choices[0].message.content.strip()
 
 # Función que genera la imagen respectivo al prompt extraido
-def crea_imagen(prompt_imagen):
-    output = client_replicate.run(
+@almacenado("crea_imagen", modelo="black-forest-labs/flux-1.1-pro", backend="replicate", ignorar=("mood",))
+def crea_imagen(prompt_imagen, mood=None):
+    prompt_imagen = prompt_con_mood(prompt_imagen, mood)
+    output = get_client_replicate().run(
         "black-forest-labs/flux-1.1-pro",
         input={"prompt": prompt_imagen}
       )
-    return output   # URL de la imagen
\ No newline at end of file
+    return output   # URL de la imagen
+
+#------------------------------------------------------ Imágenes locales y miniaturas ----------------------------------------#
+
+# Anchos de las miniaturas que se generan para cada imagen (la app elige la más adecuada)
+ANCHOS_MINIATURA = (320, 640, 1024)
+
+_sesion_http = None
+_lock_sesion_http = threading.Lock()
+
+# Función que devuelve una sesión HTTP compartida, con pool de conexiones y reintentos con backoff exponencial
+def sesion_http():
+    global _sesion_http
+    if _sesion_http is None:
+        with _lock_sesion_http:
+            if _sesion_http is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                reintentos = Retry(total=4, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+                sesion = requests.Session()
+                sesion.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=reintentos))
+                sesion.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=reintentos))
+                _sesion_http = sesion
+    return _sesion_http
+
+# Función que obtiene la URL de la salida de Replicate (texto, FileOutput o lista de ellos)
+def url_imagen(output):
+    if isinstance(output, str):
+        return output
+    elif isinstance(output, list) and output:
+        return str(output[0])
+    else:
+        return str(output)
+
+# Función que descarga una sola vez la imagen generada (las URLs de Replicate caducan) y la guarda en el almacén
+@almacenado("descargar_imagen", backend="replicate")
+def descargar_imagen(url):
+    respuesta = sesion_http().get(str(url), timeout=30)
+    respuesta.raise_for_status()
+    return respuesta.content
+
+# Función que devuelve la miniatura WEBP de una imagen, direccionada por el hash de su contenido y el ancho
+@medido()
+def miniatura(imagen_bytes, ancho):
+    llave = almacen.llave("miniatura", "", "webp", [hashlib.sha256(imagen_bytes).hexdigest(), ancho])
+    encontrado, valor = almacen.get(llave, "miniatura")
+    if encontrado:
+        return valor
+
+    from PIL import Image
+
+    imagen = Image.open(BytesIO(imagen_bytes))
+    imagen.thumbnail((ancho, ancho * 4))
+    salida = BytesIO()
+    imagen.save(salida, format="WEBP", quality=85)
+    valor = salida.getvalue()
+    almacen.put(llave, valor, "miniatura")
+    return valor
+
+# Función que materializa localmente la imagen generada: descarga el original y prepara todas sus miniaturas
+@medido()
+def materializar_imagen(url, anchos=ANCHOS_MINIATURA):
+    imagen_bytes = descargar_imagen(url)
+    return {ancho: miniatura(imagen_bytes, ancho) for ancho in anchos}
+
+# Función que genera la voz sintética (audiolibro) del texto
+@almacenado("text_to_speech", backend="openai")
+def text_to_speech(texto, model_name="gpt-4o-mini-tts", voice="onyx"):
+    speech = get_client().audio.speech.create(model=model_name, voice=voice, input=texto)
+    return speech.read()
+
+#------------------------------------------------------ Audiolibro por partes -------------------------------------------------#
+
+# Tamaño máximo de cada parte enviada a la API de voz (el límite de la API es 4096 caracteres;
+# partes más cortas hacen que la primera suene antes)
+TTS_MAX_CARACTERES = int(os.getenv("BOOKSLIVES_TTS_MAX_CARACTERES", "1000"))
+TTS_WORKERS = int(os.getenv("BOOKSLIVES_TTS_WORKERS", "4"))
+executor_tts = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="bookslives-tts")
+
+# Función que divide el texto en partes que terminan en fin de oración y no superan `max_caracteres`
+def dividir_texto(texto, max_caracteres=TTS_MAX_CARACTERES):
+    oraciones = re.split(r"(?<=[.!?…;:])\s+", texto.strip())
+    partes = []
+    actual = ""
+    for oracion in oraciones:
+        # Oraciones más largas que el máximo se cortan por palabras
+        while len(oracion) > max_caracteres:
+            corte = oracion.rfind(" ", 0, max_caracteres)
+            corte = corte if corte > 0 else max_caracteres
+            if actual:
+                partes.append(actual)
+                actual = ""
+            partes.append(oracion[:corte].strip())
+            oracion = oracion[corte:].strip()
+        if actual and len(actual) + 1 + len(oracion) > max_caracteres:
+            partes.append(actual)
+            actual = oracion
+        else:
+            actual = f"{actual} {oracion}".strip()
+    if actual:
+        partes.append(actual)
+    return partes
+
+# Función que sintetiza todas las partes en paralelo y las une en un único MP3 (los frames MP3 se pueden concatenar).
+# Cada parte se guarda por separado en el almacén, así que un re-corte del texto reutiliza las partes ya generadas.
+@medido()
+def text_to_speech_completo(texto, model_name="gpt-4o-mini-tts", voice="onyx"):
+    partes = dividir_texto(texto)
+    futuros = [executor_tts.submit(con_contexto(text_to_speech), parte, model_name=model_name, voice=voice) for parte in partes]
+    return b"".join(futuro.result() for futuro in futuros)
+
+#------------------------------------------------------ Ejecución concurrente de tareas ---------------------------------------#
+
+# Número de hilos para las llamadas independientes de IA de cada página (compartidos por todas las sesiones)
+MAX_WORKERS_PAGINA = int(os.getenv("BOOKSLIVES_WORKERS", "8"))
+executor_paginas = ThreadPoolExecutor(max_workers=MAX_WORKERS_PAGINA, thread_name_prefix="bookslives")
+
+# Función que lanza a la vez varias tareas independientes. Recibe {nombre: (función, *argumentos)}
+def lanzar_tareas(tareas, executor=None):
+    executor = executor or executor_paginas
+    # Cada tarea corre con el contexto de quien la lanza, así sus mediciones quedan en la traza de la página
+    return {nombre: executor.submit(con_contexto(funcion), *args) for nombre, (funcion, *args) in tareas.items()}
+
+# Función que entrega (nombre, resultado, error) de cada tarea en el orden en que van terminando
+def resultados_a_medida(futuros, nombres=None):
+    pendientes = {futuro: nombre for nombre, futuro in futuros.items() if nombres is None or nombre in nombres}
+    for futuro in as_completed(pendientes):
+        nombre = pendientes[futuro]
+        try:
+            yield nombre, futuro.result(), None
+        except Exception as exc:
+            yield nombre, None, exc
+
+# Función que espera a una tarea previa (p. ej. una precarga en curso) antes de ejecutar otra, para no duplicar trabajo
+def despues_de(futuro, funcion, *args):
+    try:
+        futuro.result()
+    except Exception:
+        # Si la tarea previa falló, la función se ejecuta normalmente
+        pass
+    return funcion(*args)
+
+#------------------------------------------------------ Precarga especulativa de páginas --------------------------------------#
+
+# Páginas por delante que se precargan y número de hilos dedicados (separados de los de la página actual)
+PREFETCH_PAGINAS = int(os.getenv("BOOKSLIVES_PREFETCH_PAGINAS", "2"))
+PREFETCH_WORKERS = int(os.getenv("BOOKSLIVES_PREFETCH_WORKERS", "2"))
+
+class Prefetcher:
+    """
+    Precarga en segundo plano el audiolibro, los sentimientos y el prompt musical de las siguientes páginas.
+    Los resultados quedan en el almacén persistente, así que al pasar de página las llamadas ya son aciertos.
+    """
+    def __init__(self, paginas=PREFETCH_PAGINAS, max_workers=PREFETCH_WORKERS):
+        self.paginas = paginas
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bookslives-prefetch")
+        self._futuros = {}   # (pdf_id, página) -> {nombre: futuro}
+        self._hechas = set()   # (pdf_id, página) ya precargadas (o intentadas): no se vuelven a lanzar
+        self._ventana = None   # (pdf_id, página) de la última programación
+        self._lock = threading.Lock()
+
+    def programar(self, documento, page_number):
+        """
+        Precarga las páginas siguientes a `page_number` y cancela las que quedaron fuera de la ventana.
+        Sólo actúa cuando la ventana cambia: los reruns de la misma página (búsquedas, botones) no relanzan nada.
+        """
+        with self._lock:
+            if self._ventana == (documento.pdf_id, page_number):
+                return
+            self._ventana = (documento.pdf_id, page_number)
+            ventana = set(range(page_number + 1, min(documento.num_pages, page_number + self.paginas) + 1))
+            for llave in list(self._futuros):
+                pdf_id, pagina = llave
+                futuros = self._futuros[llave]
+                if pdf_id == documento.pdf_id and pagina not in ventana:
+                    # Sólo se cancelan las que aún no empezaron (p. ej. tras un salto con "Ir a página")
+                    for futuro in futuros.values():
+                        futuro.cancel()
+                if all(futuro.done() for futuro in futuros.values()):
+                    del self._futuros[llave]
+                    # Las canceladas podrán volver a lanzarse; las terminadas (bien o con error) no
+                    if not any(futuro.cancelled() for futuro in futuros.values()):
+                        self._hechas.add(llave)
+            for pagina in sorted(ventana):
+                llave = (documento.pdf_id, pagina)
+                if llave not in self._futuros and llave not in self._hechas:
+                    self._futuros[llave] = self._lanzar(documento, pagina)
+
+    def _lanzar(self, documento, pagina):
+        # El texto se extrae dentro del hilo para no bloquear el rerun
+        def con_texto(funcion):
+            def tarea():
+                texto = documento.texto(pagina)
+                return funcion(texto) if texto.strip() else None
+            return tarea
+        return {
+            "audiolibro": self._executor.submit(con_texto(text_to_speech_completo)),
+            # Las emociones precargadas también llenan la línea de tiempo del libro
+            "sentimientos": self._executor.submit(linea_emociones(documento).puntuar, pagina),
+            "prompt_musica": self._executor.submit(con_texto(text_to_music)),
+        }
+
+    def reclamar(self, pdf_id, page_number):
+        """Devuelve (y deja de gestionar) las precargas en curso de una página que el lector acaba de abrir."""
+        with self._lock:
+            futuros = self._futuros.pop((pdf_id, page_number), {})
+            self._hechas.add((pdf_id, page_number))
+        return {nombre: futuro for nombre, futuro in futuros.items() if not futuro.cancelled()}
+
+
+prefetcher = Prefetcher()
+
+#------------------------------------------------------ Caché semántica de música e imágenes ----------------------------------#
+
+# Si está activa, las páginas con prompts casi iguales reutilizan la misma música o imagen
+SEMANTICA_ACTIVA = os.getenv("BOOKSLIVES_SEMANTICA", "1") == "1"
+EMBEDDING_MODEL = os.getenv("BOOKSLIVES_EMBEDDING_MODEL", "text-embedding-3-small")
+
+cache_semantica_musica = CacheSemantica("musica", modelo=EMBEDDING_MODEL)
+cache_semantica_imagen = CacheSemantica("imagen", modelo=EMBEDDING_MODEL)
+# La música larga tiene su propio índice: un clip corto parecido no evita generar la pista larga
+cache_semantica_musica_larga = CacheSemantica("musica_larga", modelo=EMBEDDING_MODEL)
+
+# Función que obtiene el embedding de un texto
+@almacenado("embedding", modelo=EMBEDDING_MODEL, backend="openai")
+def embedding(texto):
+    respuesta = get_client().embeddings.create(model=EMBEDDING_MODEL, input=texto)
+    registrar_tokens(respuesta)
+    return respuesta.data[0].embedding
+
+# Función que genera (o reutiliza por similitud) la música de un prompt
+@medido()
+def musica_semantica(prompt_from_text, mood=None):
+    if SEMANTICA_ACTIVA:
+        return cache_semantica_musica.obtener(embedding(prompt_from_text), prompt_from_text, lambda prompt: musicgen_generation(prompt, mood=mood))
+    return musicgen_generation(prompt_from_text, mood=mood)
+
+# Función que genera (o reutiliza por similitud) la música larga de un prompt
+@medido()
+def musica_larga_semantica(prompt_from_text, duracion=60.0, al_segmento=None, mood=None):
+    def generar(prompt):
+        return musica_larga(prompt, duracion=duracion, al_segmento=al_segmento, mood=mood)
+    if SEMANTICA_ACTIVA:
+        return cache_semantica_musica_larga.obtener(embedding(prompt_from_text), prompt_from_text, generar)
+    return generar(prompt_from_text)
+
+# Función que genera (o reutiliza por similitud) la imagen de un prompt
+@medido()
+def imagen_semantica(prompt_imagen, mood=None):
+    if SEMANTICA_ACTIVA:
+        return cache_semantica_imagen.obtener(embedding(prompt_imagen), prompt_imagen, lambda prompt: crea_imagen(prompt, mood=mood))
+    return crea_imagen(prompt_imagen, mood=mood)
+
+#------------------------------------------------------ Insights a nivel de libro (map-reduce incremental) -------------------#
+
+# Si está activo, los insights de cada página combinan un estado del libro completo con un delta barato de la página
+INSIGHTS_LIBRO = os.getenv("BOOKSLIVES_INSIGHTS_LIBRO", "0") == "1"
+# Páginas que se resumen juntas en cada bloque (aproximación a un capítulo)
+PAGINAS_POR_BLOQUE = int(os.getenv("BOOKSLIVES_PAGINAS_POR_BLOQUE", "10"))
+executor_insights = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bookslives-insights")
+# Las actualizaciones esperan a las tareas map/reduce, así que corren en un pool aparte para no bloquearlo
+executor_insights_fondo = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bookslives-insights-fondo")
+
+# Campos de BookInsights que describen al libro completo y no cambian entre páginas
+CAMPOS_LIBRO = ("Título", "Autor", "Obras_relacionadas", "Premios", "Personajes_principales", "Época")
+
+prompt_fusion_insights = """Eres un experto Analista de libros y novelas. Recibirás dos JSON con insights (esquema BookInsights) de
+dos partes consecutivas del mismo libro. Fusiónalos en un único BookInsights del conjunto: conserva el título y autor más
+fiables, une personajes, tópicos y temas sin repetir (respetando los máximos del esquema) y escribe un resumen de ambas partes.
+Devuelve SOLO un JSON válido que siga exactamente el esquema de BookInsights. Salidas en español."""
+
+class InsightsDeltaPagina(BaseModel):
+    """
+    Insights propios de una página, calculados con el contexto del libro ya conocido.
+    """
+    Sentimiento: Optional[str] = Field(description="Sentimiento general de la página: Alegría / Tristeza / Miedo / Enojo / Sorpresa")
+    Resumen: str = Field(description="Idea principal de la página en español (párrafo de 3 líneas)")
+    Tópicos: List[str] = Field(default_factory=list, description="Tópicos principales de la página, cado uno con un máximo de 3 palabras, en español")
+    Lugar_hechos: Optional[str] = Field(description="Lugar o escenario donde ocurre la acción de la página.")
+    Temas_adicionales: List[str] = Field(default_factory=list, description="Otros temas de la página, con un máximo de 3 palabras cada uno.")
+    Narrativa: Optional[str] = Field(description="El tono de la narración en la página: Melancólico / Misterioso / Nostálgico / introspectivo).")
+
+# Función reduce: fusiona los insights de dos partes del libro en uno solo
+@almacenado("fusionar_insights", version=prompt_fusion_insights, backend="openai")
+def fusionar_insights(client, insights_a: dict, insights_b: dict, model_name: str = "gpt-5-mini") -> dict:
+    response = client.chat.completions.parse(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": prompt_fusion_insights},
+            {"role": "user", "content": json.dumps([insights_a, insights_b], ensure_ascii=False)},
+        ],
+        response_format=BookInsights,
+    )
+    registrar_tokens(response)
+    return response.choices[0].message.parsed.model_dump()
+
+# Función que obtiene sólo los insights propios de la página y los completa con los del libro
+@almacenado("insights_pagina_delta", version=InsightsDeltaPagina.model_json_schema(), backend="openai")
+def insights_pagina_delta(client, texto: str, contexto_libro: dict, model_name: str = "gpt-5-mini") -> dict:
+    response = client.chat.completions.parse(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": "Eres un experto Analista de libros y novelas. Ya se conoce este contexto del libro: "
+                                          f"{json.dumps(contexto_libro, ensure_ascii=False)}. Analiza sólo la página recibida. "
+                                          "Devuelve SOLO un JSON válido que siga exactamente el esquema de InsightsDeltaPagina. Salidas en español."},
+            {"role": "user", "content": texto},
+        ],
+        response_format=InsightsDeltaPagina,
+    )
+    registrar_tokens(response)
+    return response.choices[0].message.parsed.model_dump()
+
+class InsightsLibro:
+    """
+    Estado de insights de un libro construido por map-reduce: cada bloque de páginas se resume en paralelo (map)
+    y los bloques nuevos se fusionan con el estado acumulado (reduce). Sólo se procesan los bloques que aún no
+    estaban en el estado, que se guarda en disco por hash del pdf.
+    """
+    def __init__(self, documento, paginas_por_bloque=PAGINAS_POR_BLOQUE, directorio=CACHE_DIR):
+        self.documento = documento
+        self.paginas_por_bloque = paginas_por_bloque
+        self.ruta = os.path.join(directorio, f"insights_{documento.pdf_id}_{paginas_por_bloque}.json")
+        self._lock = threading.Lock()
+        self._actualizando = None
+        self.bloques = {}
+        self.libro = None
+        self.cubiertos = set()   # bloques ya fusionados en self.libro
+        self._combinar_disco()
+
+    def _leer_disco(self):
+        if not os.path.exists(self.ruta):
+            return None
+        try:
+            with open(self.ruta, "r") as f:
+                estado = json.load(f)
+        except (OSError, ValueError):
+            return None
+        bloques = {int(b): insights for b, insights in estado["bloques"].items()}
+        return bloques, estado["libro"], set(estado.get("cubiertos", bloques))
+
+    def _combinar_disco(self):
+        """Suma lo que otro proceso (p. ej. pregenera.py) dejó en disco: bloques que falten aquí y, si cubre más, su estado del libro."""
+        leido = self._leer_disco()
+        if leido is None:
+            return
+        bloques, libro, cubiertos = leido
+        for b, insights in bloques.items():
+            self.bloques.setdefault(b, insights)
+        if libro is not None and len(cubiertos) > len(self.cubiertos):
+            self.libro, self.cubiertos = libro, cubiertos
+
+    def _texto_bloque(self, bloque):
+        inicio = bloque * self.paginas_por_bloque + 1
+        fin = min(self.documento.num_pages, inicio + self.paginas_por_bloque - 1)
+        return "\n".join(self.documento.texto(p) for p in range(inicio, fin + 1))
+
+    def _guardar(self):
+        # Combinar con el disco bajo el bloqueo: reescribir solo el estado en memoria borraría lo de otro proceso
+        with bloqueo_archivo(self.ruta):
+            self._combinar_disco()
+            temporal = f"{self.ruta}.tmp"
+            with open(temporal, "w") as f:
+                json.dump({"bloques": self.bloques, "libro": self.libro, "cubiertos": sorted(self.cubiertos)}, f, ensure_ascii=False)
+            os.replace(temporal, self.ruta)
+
+    def actualizar(self, hasta_pagina):
+        """Incorpora al estado todos los bloques completos hasta `hasta_pagina` (el último bloque cuenta si el libro termina)."""
+        completos = hasta_pagina // self.paginas_por_bloque
+        if hasta_pagina >= self.documento.num_pages:
+            completos = -(-self.documento.num_pages // self.paginas_por_bloque)
+        with self._lock:
+            self._combinar_disco()
+            nuevos = [b for b in range(completos) if b not in self.cubiertos]
+            resumidos = {b: self.bloques[b] for b in nuevos if b in self.bloques}
+            libro_base = self.libro
+        if not nuevos:
+            return self.libro
+
+        # Map: resumen en paralelo de cada bloque nuevo (los que otro proceso ya resumió se reutilizan)
+        futuros = {b: executor_insights.submit(con_contexto(get_book_insights), get_client(), self._texto_bloque(b)) for b in nuevos if b not in resumidos}
+        resumidos.update({b: futuro.result() for b, futuro in futuros.items()})
+        parciales = [resumidos[b] for b in nuevos]
+
+        # Reduce en árbol de los bloques nuevos (las fusiones de cada nivel van en paralelo)
+        while len(parciales) > 1:
+            pares = [executor_insights.submit(con_contexto(fusionar_insights), get_client(), a, b) for a, b in zip(parciales[0::2], parciales[1::2])]
+            impar = [parciales[-1]] if len(parciales) % 2 else []
+            parciales = [futuro.result() for futuro in pares] + impar
+
+        # Fusión incremental con el estado ya acumulado
+        libro = parciales[0] if libro_base is None else fusionar_insights(get_client(), libro_base, parciales[0])
+        with self._lock:
+            self.libro = libro
+            self.cubiertos |= set(nuevos)
+            self.bloques.update(resumidos)
+            self._guardar()
+            return self.libro
+
+    def actualizar_en_segundo_plano(self, hasta_pagina):
+        """Lanza la actualización si no hay otra en curso; devuelve el estado actual sin esperar."""
+        with self._lock:
+            if self._actualizando is None or self._actualizando.done():
+                self._actualizando = executor_insights_fondo.submit(self.actualizar, hasta_pagina)
+            return self.libro
+
+    def insights_pagina(self, page_number):
+        """Insights de la página: estado del libro + delta de la página (o insights completos si aún no hay estado)."""
+        texto = self.documento.texto(page_number)
+        libro = self.actualizar_en_segundo_plano(page_number)
+        if libro is None:
+            return get_book_insights(get_client(), texto)
+        contexto = {campo: libro.get(campo) for campo in ("Título", "Autor", "Personajes_principales")}
+        insights = {campo: libro.get(campo) for campo in CAMPOS_LIBRO}
+        insights.update(insights_pagina_delta(get_client(), texto, contexto))
+        return insights
+
+
+_insights_libros = {}
+_lock_insights_libros = threading.Lock()
+
+# Función que devuelve el estado de insights del libro (uno por pdf en el proceso)
+def insights_libro(documento):
+    with _lock_insights_libros:
+        estado = _insights_libros.get(documento.pdf_id)
+        if estado is None:
+            estado = _insights_libros[documento.pdf_id] = InsightsLibro(documento)
+        return estado
+
+#------------------------------------------------------ Línea de tiempo de emociones del libro -------------------------------#
+
+# Páginas de la ventana (centrada) con la que se suaviza la línea de emociones
+EMOCIONES_VENTANA = int(os.getenv("BOOKSLIVES_EMOCIONES_VENTANA", "5"))
+# Si está activo, la música y la imagen añaden a su prompt el ánimo suavizado de las páginas cercanas ya puntuadas
+# (la llave en el almacén sigue siendo el prompt sin ánimo, así que releer una página no vuelve a generar)
+MOOD_LOCAL = os.getenv("BOOKSLIVES_MOOD_LOCAL", "1") == "1"
+# Descriptores (en inglés, como los prompts de MusicGen y FLUX) de cada emoción
+DESCRIPTORES_EMOCION = {
+    "alegria": "joyful, uplifting",
+    "tristeza": "melancholic, somber",
+    "miedo": "tense, ominous",
+    "enojo": "intense, aggressive",
+    "sorpresa": "playful, unexpected",
+    "neutralidad": "calm, contemplative",
+}
+
+# Función que convierte el diccionario de emociones (fracciones o porcentajes, números o texto) en un vector float32
+def vector_emociones(emociones):
+    valores = []
+    for emocion in EMOCIONES:
+        valor = str((emociones or {}).get(emocion, 0.0)).strip()
+        try:
+            valores.append(float(valor.rstrip("%")) / (100.0 if valor.endswith("%") else 1.0))
+        except ValueError:
+            valores.append(0.0)
+    vector = np.asarray(valores, dtype=np.float32)
+    # El LLM a veces responde en porcentaje sin el signo
+    if vector.max(initial=0.0) > 1.0:
+        vector /= 100.0
+    return vector
+
+# Función que promedia por ventanas ignorando las páginas sin puntuar (NaN), con sumas acumuladas: O(páginas)
+def _promedio_por_rangos(matriz, inicio, fin):
+    valida = ~np.isnan(matriz[:, 0])
+    valores = np.where(valida[:, None], matriz, 0.0).astype(np.float64)
+    suma = np.concatenate([np.zeros((1, matriz.shape[1])), np.cumsum(valores, axis=0)])
+    cuenta = np.concatenate([[0], np.cumsum(valida)])
+    total = suma[fin] - suma[inicio]
+    paginas = (cuenta[fin] - cuenta[inicio])[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total / paginas).astype(np.float32)   # NaN donde la ventana no tiene páginas puntuadas
+
+class LineaEmociones:
+    """
+    Emociones de todas las páginas de un libro en un arreglo float32 de forma (páginas, 6), guardado por hash del pdf.
+    Las páginas aún no puntuadas son NaN; se llena al leer (una página a la vez) o por lotes.
+    """
+    def __init__(self, documento, directorio=CACHE_DIR):
+        self.documento = documento
+        self.ruta = os.path.join(directorio, f"emociones_{documento.pdf_id}.npy")
+        self._lock = threading.Lock()
+        self._completando = None
+        self._mtime = None
+        self.matriz = np.full((documento.num_pages, len(EMOCIONES)), np.nan, dtype=np.float32)
+        self._combinar_disco()
+
+    def _combinar_disco(self):
+        """Llena las páginas que aquí siguen en NaN con lo que otro proceso (p. ej. pregenera.py) ya dejó en disco."""
+        try:
+            mtime = os.path.getmtime(self.ruta)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            en_disco = np.load(self.ruta)
+        except (OSError, ValueError):
+            return
+        self._mtime = mtime
+        if en_disco.shape != self.matriz.shape:
+            return
+        faltan = np.isnan(self.matriz[:, 0])
+        self.matriz[faltan] = en_disco[faltan]
+
+    def _guardar(self):
+        # Bajo el bloqueo del archivo se combina primero con el disco: escribir solo lo de memoria
+        # borraría las páginas que puntuó otro proceso desde que se cargó el libro
+        with bloqueo_archivo(self.ruta):
+            self._combinar_disco()
+            temporal = f"{self.ruta}.tmp"
+            with open(temporal, "wb") as f:
+                np.save(f, self.matriz)
+            os.replace(temporal, self.ruta)
+            self._mtime = os.path.getmtime(self.ruta)
+
+    def registrar(self, page_number, emociones):
+        """Guarda las emociones (diccionario) de una página ya puntuada."""
+        with self._lock:
+            self.matriz[page_number - 1] = vector_emociones(emociones)
+            self._guardar()
+
+    def puntuar(self, page_number):
+        """Emociones de la página (del almacén si ya se calcularon) y las deja en la línea de tiempo."""
+        texto = self.documento.texto(page_number)
+        if not texto.strip():
+            return None
+        emociones = vector_sentimientos(texto)
+        self.registrar(page_number, emociones)
+        return emociones
+
+    def pendientes(self):
+        with self._lock:
+            self._combinar_disco()
+            return [int(i) + 1 for i in np.flatnonzero(np.isnan(self.matriz[:, 0]))]
+
+    def puntuar_lote(self, paginas=None, tamano_lote=SENTIMIENTO_BATCH):
+        """Puntúa por lotes las páginas indicadas (por defecto todas las pendientes), guardando tras cada lote."""
+        paginas = self.pendientes() if paginas is None else list(paginas)
+        for inicio in range(0, len(paginas), tamano_lote):
+            lote = [p for p in paginas[inicio:inicio + tamano_lote] if self.documento.texto(p).strip()]
+            if not lote:
+                continue
+            resultados = vector_sentimientos_lote([self.documento.texto(p) for p in lote])
+            with self._lock:
+                for page_number, emociones in zip(lote, resultados):
+                    self.matriz[page_number - 1] = vector_emociones(emociones)
+                self._guardar()
+
+    def completar_en_segundo_plano(self):
+        """Lanza la puntuación de las páginas pendientes si no hay otra en curso."""
+        with self._lock:
+            if self._completando is None or self._completando.done():
+                self._completando = executor_insights_fondo.submit(self.puntuar_lote)
+            return self._completando
+
+    def avance(self):
+        """Devuelve (páginas puntuadas, total)."""
+        with self._lock:
+            self._combinar_disco()
+            return int(np.count_nonzero(~np.isnan(self.matriz[:, 0]))), len(self.matriz)
+
+    def suavizada(self, ventana=EMOCIONES_VENTANA):
+        """Promedio móvil centrado de `ventana` páginas (NaN donde no hay páginas puntuadas cerca)."""
+        with self._lock:
+            self._combinar_disco()
+            matriz = self.matriz.copy()
+        n = len(matriz)
+        indices = np.arange(n)
+        return _promedio_por_rangos(matriz, np.clip(indices - ventana // 2, 0, n), np.clip(indices + ventana // 2 + 1, 0, n))
+
+    def por_bloque(self, paginas_por_bloque=PAGINAS_POR_BLOQUE):
+        """Promedio por bloques de páginas (los mismos bloques que los insights del libro): forma (bloques, 6)."""
+        with self._lock:
+            self._combinar_disco()
+            matriz = self.matriz.copy()
+        inicio = np.arange(0, len(matriz), paginas_por_bloque)
+        return _promedio_por_rangos(matriz, inicio, np.minimum(inicio + paginas_por_bloque, len(matriz)))
+
+    def mood_local(self, page_number, ventana=EMOCIONES_VENTANA):
+        """Emociones suavizadas alrededor de la página como diccionario, o None si no hay páginas puntuadas cerca."""
+        n = len(self.matriz)
+        inicio = np.array([max(0, page_number - 1 - ventana // 2)])
+        fin = np.array([min(n, page_number + ventana // 2)])
+        with self._lock:
+            self._combinar_disco()
+            fila = _promedio_por_rangos(self.matriz, inicio, fin)[0]
+        if np.isnan(fila[0]):
+            return None
+        return {emocion: round(float(valor), 3) for emocion, valor in zip(EMOCIONES, fila)}
+
+_lineas_emociones = {}
+_lock_lineas_emociones = threading.Lock()
+
+# Función que devuelve la línea de tiempo de emociones del libro (una por pdf en el proceso)
+def linea_emociones(documento):
+    with _lock_lineas_emociones:
+        linea = _lineas_emociones.get(documento.pdf_id)
+        if linea is None:
+            linea = _lineas_emociones[documento.pdf_id] = LineaEmociones(documento)
+        return linea
+
+# Función que añade al prompt (de música o imagen) el ánimo dominante de las páginas cercanas, sin llamadas extra.
+# Se aplica dentro de la generación: la llave del almacén es el prompt sin ánimo, que no depende de qué vecinas
+# estaban puntuadas al hacer clic
+def prompt_con_mood(prompt, mood, emociones_maximas=2, minimo=0.15):
+    if not prompt or not mood:
+        return prompt
+    dominantes = [emocion for emocion, valor in sorted(mood.items(), key=lambda x: -x[1])[:emociones_maximas] if valor >= minimo]
+    if not dominantes:
+        return prompt
+    return f"{prompt.rstrip('. ')}. Overall mood: {', '.join(DESCRIPTORES_EMOCION[emocion] for emocion in dominantes)}"
@@ -0,0 +1,163 @@
+# Aquí definimos el proceso trabajador de MusicGen de BooksLives: la generación de música corre fuera del proceso de
+# Streamlit, alimentada por una cola de trabajos, y agrupa en un solo llamado al pipeline los prompts pendientes.
+
+# Librerias a utilizar
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as FuturoTimeoutError
+
+#------------------------------------------------------ Configuración del trabajador --------------------------------------------#
+
+# Número máximo de prompts que se generan juntos en una pasada del modelo
+MUSICGEN_BATCH = int(os.getenv("MUSICGEN_BATCH", "4"))
+# Segundos que el trabajador espera a que lleguen más trabajos antes de lanzar un lote
+MUSICGEN_BATCH_ESPERA = float(os.getenv("MUSICGEN_BATCH_ESPERA", "0.05"))
+# Tokens de audio de MusicGen por segundo (512 tokens ≈ 10 segundos)
+TOKENS_POR_SEGUNDO = 50
+# Cada cuántos segundos se comprueba, mientras no llegan resultados, que el trabajador siga vivo
+MUSICGEN_VIGILANCIA = 1.0
+
+#------------------------------------------------------ Proceso trabajador ---------------------------------------------------#
+
+# Función principal del proceso trabajador: recibe (id, prompt, max_new_tokens) y devuelve (id, audio_bytes, error)
+def _bucle_trabajador(trabajos, resultados, batch, espera):
+    # Las dependencias pesadas sólo se importan dentro del trabajador
+    from Tools_BooksLives import modelo_musicgen, codificar_audio
+
+    synthesiser = modelo_musicgen.get()
+    while True:
+        trabajo = trabajos.get()
+        if trabajo is None:
+            break
+        lote = [trabajo]
+        # Junta los trabajos que llegan casi al mismo tiempo
+        while len(lote) < batch:
+            try:
+                siguiente = trabajos.get(timeout=espera)
+            except queue.Empty:
+                break
+            if siguiente is None:
+                trabajos.put(None)
+                break
+            lote.append(siguiente)
+
+        # Sólo se pueden generar juntos los prompts con la misma duración
+        lote.sort(key=lambda t: t[2])
+        for max_new_tokens, grupo in itertools.groupby(lote, key=lambda t: t[2]):
+            grupo = list(grupo)
+            try:
+                salidas = synthesiser(
+                    [prompt for _, prompt, _ in grupo],
+                    forward_params={"do_sample": True, "max_new_tokens": max_new_tokens},
+                    batch_size=len(grupo),
+                )
+                for (id_trabajo, _, _), music in zip(grupo, salidas):
+                    # Los memoryview no se pueden enviar entre procesos: se envían los bytes ya comprimidos
+                    resultados.put((id_trabajo, bytes(codificar_audio(music["audio"], music["sampling_rate"])), None))
+            except Exception as exc:
+                for id_trabajo, _, _ in grupo:
+                    resultados.put((id_trabajo, None, repr(exc)))
+
+#------------------------------------------------------ Cliente (lado de Streamlit) ---------------------------------------------#
+
+class ClienteMusicGen:
+    """
+    Envía trabajos (prompt, duración) al proceso trabajador y devuelve futuros con los bytes WAV.
+    El proceso se arranca la primera vez que se usa y es compartido por todas las sesiones.
+    """
+    def __init__(self, batch=MUSICGEN_BATCH, espera=MUSICGEN_BATCH_ESPERA):
+        self.batch = batch
+        self.espera = espera
+        self._contexto = mp.get_context("spawn")
+        self._proceso = None
+        self._trabajos = None
+        self._resultados = None
+        self._pendientes = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _arrancar(self):
+        # Si el trabajador anterior murió, sus trabajos pendientes ya no tendrán respuesta
+        for futuro in self._pendientes.values():
+            futuro.set_exception(RuntimeError("El trabajador de MusicGen se detuvo"))
+        self._pendientes.clear()
+        self._trabajos = self._contexto.Queue()
+        self._resultados = self._contexto.Queue()
+        self._proceso = self._contexto.Process(
+            target=_bucle_trabajador,
+            args=(self._trabajos, self._resultados, self.batch, self.espera),
+            name="bookslives-musicgen",
+            daemon=True,
+        )
+        self._proceso.start()
+        threading.Thread(
+            target=self._recibir, args=(self._proceso, self._resultados), name="bookslives-musicgen-resultados", daemon=True
+        ).start()
+
+    def _fallar_pendientes(self, proceso):
+        # Los trabajos enviados a un trabajador muerto nunca tendrán respuesta
+        with self._lock:
+            if proceso is not self._proceso:
+                return
+            pendientes, self._pendientes = self._pendientes, {}
+        for futuro in pendientes.values():
+            futuro.set_exception(RuntimeError(f"El trabajador de MusicGen se detuvo (código {proceso.exitcode})"))
+
+    def _recibir(self, proceso, resultados):
+        while True:
+            try:
+                id_trabajo, wav_bytes, error = resultados.get(timeout=MUSICGEN_VIGILANCIA)
+            except queue.Empty:
+                if not proceso.is_alive():
+                    self._fallar_pendientes(proceso)
+                    return
+                continue
+            with self._lock:
+                futuro = self._pendientes.pop(id_trabajo, None)
+            if futuro is None:
+                continue
+            if error is not None:
+                futuro.set_exception(RuntimeError(f"Error en el trabajador de MusicGen: {error}"))
+            else:
+                futuro.set_result(wav_bytes)
+
+    def submit(self, prompt, duracion=None, max_new_tokens=512):
+        """Encola un trabajo; `duracion` en segundos tiene prioridad sobre `max_new_tokens`."""
+        if duracion is not None:
+            max_new_tokens = int(duracion * TOKENS_POR_SEGUNDO)
+        futuro = Future()
+        with self._lock:
+            if self._proceso is None or not self._proceso.is_alive():
+                self._arrancar()
+            id_trabajo = next(self._ids)
+            self._pendientes[id_trabajo] = futuro
+        self._trabajos.put((id_trabajo, prompt, max_new_tokens))
+        return futuro
+
+    def generar(self, prompt, duracion=None, max_new_tokens=512, timeout=None):
+        futuro = self.submit(prompt, duracion=duracion, max_new_tokens=max_new_tokens)
+        try:
+            return futuro.result(timeout=timeout)
+        except FuturoTimeoutError:
+            # Se deja de esperar el trabajo; si el trabajador lo termina después, su resultado se descarta
+            with self._lock:
+                for id_trabajo, pendiente in list(self._pendientes.items()):
+                    if pendiente is futuro:
+                        del self._pendientes[id_trabajo]
+            raise
+
+    def profundidad(self):
+        """Trabajos enviados que aún no tienen resultado (en cola o generándose)."""
+        with self._lock:
+            return len(self._pendientes)
+
+    def close(self):
+        if self._proceso is not None and self._proceso.is_alive():
+            self._trabajos.put(None)
+            self._proceso.join(timeout=5)
+
+
+cliente_musicgen = ClienteMusicGen()
@@ -0,0 +1,66 @@
+# arranque.py
+# Informe del tiempo de arranque de BooksLives: cuánto cuesta importar cada módulo antes de que se pinte el lector.
+# Usa `python -X importtime` en un proceso limpio, así que mide un arranque en frío real.
+#
+# Uso:
+#   python arranque.py --top 20
+
+# Librerias a utilizar
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+# Módulos que importa la app al arrancar
+MODULOS_APP = ("streamlit", "Metricas_BooksLives", "Cache_BooksLives", "Tools_BooksLives", "Pdf_BooksLives", "Progreso_BooksLives")
+# Librerías que no deberían cargarse hasta su primer uso
+MODULOS_PESADOS = ("torch", "transformers", "scipy", "openai", "replicate", "requests")
+
+#------------------------------------------------------ Medición -------------------------------------------------------------#
+
+# Función que importa los módulos en un proceso nuevo y devuelve [(módulo, self_us, acumulado_us)]
+def medir_importaciones(modulos=MODULOS_APP):
+    codigo = "; ".join(f"import {modulo}" for modulo in modulos)
+    proceso = subprocess.run([sys.executable, "-X", "importtime", "-c", codigo], capture_output=True, text=True)
+    if proceso.returncode != 0:
+        raise RuntimeError(proceso.stderr.strip().splitlines()[-1])
+    tiempos = []
+    for linea in proceso.stderr.splitlines():
+        if not linea.startswith("import time:") or "[us]" in linea:
+            continue
+        propio, acumulado, nombre = linea[len("import time:"):].split("|")
+        tiempos.append((nombre.strip(), int(propio), int(acumulado)))
+    return tiempos
+
+#------------------------------------------------------ Punto de entrada -----------------------------------------------------#
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Desglose del costo de importación de BooksLives por módulo.")
+    parser.add_argument("--top", type=int, default=15, help="Número de paquetes más costosos a mostrar")
+    args = parser.parse_args(argv)
+
+    tiempos = medir_importaciones()
+    acumulados = {nombre: acumulado for nombre, _, acumulado in tiempos}
+
+    # Tiempo propio agregado por paquete raíz
+    por_paquete = defaultdict(int)
+    for nombre, propio, _ in tiempos:
+        por_paquete[nombre.split(".")[0]] += propio
+    total = sum(por_paquete.values())
+
+    print(f"Tiempo total de importación: {total / 1e6:.3f} s\n")
+    print("Módulos de la app (acumulado):")
+    for modulo in MODULOS_APP:
+        print(f"  {modulo:<24} {acumulados.get(modulo, 0) / 1e6:8.3f} s")
+
+    print("\nPaquetes más costosos (tiempo propio):")
+    for paquete, propio in sorted(por_paquete.items(), key=lambda x: -x[1])[:args.top]:
+        print(f"  {paquete:<24} {propio / 1e6:8.3f} s  {100 * propio / total:5.1f}%")
+
+    cargados = [paquete for paquete in MODULOS_PESADOS if paquete in por_paquete]
+    print(f"\nLibrerías pesadas cargadas al arrancar: {', '.join(cargados) if cargados else 'ninguna'}")
+    return 1 if cargados else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
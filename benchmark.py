@@ -0,0 +1,505 @@
+# benchmark.py
+# Benchmark offline del pipeline de página de BooksLives: todo corre contra un servidor local que imita a OpenAI y
+# Replicate con latencia configurable y contra un MusicGen de juguete, así que no gasta créditos ni depende de la red.
+# Mide la latencia por etapa (p50/p95/p99), el rendimiento con N lectores simultáneos y la memoria máxima, y guarda
+# los resultados en JSON para comparar entre commits.
+#
+# Uso:
+#   python benchmark.py --lectores 1 4 8 --paginas 5 --latencia-openai 0.3 --latencia-musicgen 1.0
+#   python benchmark.py --comparar bench_a1b2c3d.json
+
+# Librerias a utilizar
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+
+# Etapas del pipeline en el orden en que se reportan
+ETAPAS = (
+    "parse", "render", "clean_text", "sentimientos", "insights", "prompt_musica", "tts",
+    "musicgen", "prompt_imagen", "imagen", "pagina",
+)
+# Palabras con las que se arma el texto del libro sintético
+VOCABULARIO = (
+    "el", "la", "noche", "mar", "camino", "silencio", "ciudad", "viento", "carta", "memoria", "fuego", "sombra",
+    "capitán", "puerto", "madre", "guerra", "jardín", "lluvia", "tren", "espejo", "secreto", "río", "invierno",
+    "montaña", "voz", "libro", "reloj", "puerta", "luz", "miedo", "alegría", "regreso", "viaje", "isla", "sueño",
+)
+
+#------------------------------------------------------ Servidor local (OpenAI + Replicate) ---------------------------------------#
+
+# Función que arma una instancia mínima válida de un JSON schema (para las salidas estructuradas de `parse`)
+def instancia_de_esquema(esquema, definiciones=None):
+    definiciones = definiciones if definiciones is not None else esquema.get("$defs", {})
+    if "$ref" in esquema:
+        return instancia_de_esquema(definiciones[esquema["$ref"].split("/")[-1]], definiciones)
+    if "anyOf" in esquema:
+        opciones = [opcion for opcion in esquema["anyOf"] if opcion.get("type") != "null"]
+        return instancia_de_esquema(opciones[0], definiciones) if opciones else None
+    tipo = esquema.get("type")
+    if tipo == "object":
+        return {nombre: instancia_de_esquema(propiedad, definiciones) for nombre, propiedad in esquema.get("properties", {}).items()}
+    if tipo == "array":
+        return [instancia_de_esquema(esquema["items"], definiciones)] if "items" in esquema else []
+    if tipo == "number":
+        return round(1 / 6, 3)
+    if tipo == "integer":
+        return 1
+    if tipo == "boolean":
+        return False
+    return "texto de prueba"
+
+# Función que arma una imagen PNG de prueba (la que "genera" Replicate)
+def png_de_prueba(lado=1024):
+    from PIL import Image
+
+    gradiente = np.linspace(0, 255, lado, dtype=np.uint8)
+    pixeles = np.stack(np.broadcast_arrays(gradiente[None, :], gradiente[:, None], np.uint8(128)), axis=-1)
+    salida = BytesIO()
+    Image.fromarray(np.ascontiguousarray(pixeles)).save(salida, format="PNG")
+    return salida.getvalue()
+
+
+class ServidorFalso:
+    """
+    Servidor HTTP local que responde como las APIs de OpenAI (chat, salidas estructuradas, voz y embeddings) y de
+    Replicate (predicciones y descarga de la imagen), con una latencia fija más un jitter exponencial por servicio.
+    """
+    def __init__(self, latencias, jitter=0.0, dimension_embedding=256, semilla=0):
+        self.latencias = latencias     # {"openai": s, "tts": s, "replicate": s}
+        self.jitter = jitter
+        self.dimension_embedding = dimension_embedding
+        self.peticiones = defaultdict(int)
+        self.png = png_de_prueba()
+        self._rng = np.random.default_rng(semilla)
+        self._lock = threading.Lock()
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", 0), self._manejador())
+        self._servidor.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._servidor.server_address[1]}"
+
+    def arrancar(self):
+        threading.Thread(target=self._servidor.serve_forever, name="bookslives-bench-servidor", daemon=True).start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def esperar(self, servicio):
+        with self._lock:
+            self.peticiones[servicio] += 1
+            extra = self._rng.exponential(self.jitter) if self.jitter > 0 else 0.0
+        time.sleep(self.latencias.get(servicio, 0.0) + extra)
+
+    # Respuestas de OpenAI
+    def chat(self, cuerpo):
+        mensajes = cuerpo.get("messages", [])
+        formato = cuerpo.get("response_format") or {}
+        if formato.get("type") == "json_schema":
+            contenido = json.dumps(instancia_de_esquema(formato["json_schema"]["schema"]), ensure_ascii=False)
+        elif "analizador de emociones" in str(mensajes[0].get("content", "")):
+            contenido = json.dumps({"alegria": 0.3, "tristeza": 0.1, "miedo": 0.1, "enojo": 0.05, "sorpresa": 0.15, "neutralidad": 0.3})
+        else:
+            # El prompt depende del texto para que cada página tenga su propia música e imagen
+            huella = hashlib.sha256(str(mensajes[-1].get("content", "")).encode("utf-8")).hexdigest()[:8]
+            contenido = f"slow cinematic strings and soft piano, melancholic, 70 bpm, scene {huella}"
+        tokens_entrada = sum(len(str(mensaje.get("content", ""))) for mensaje in mensajes) // 4
+        tokens_salida = len(contenido) // 4
+        return {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": cuerpo.get("model", ""),
+            "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                         "message": {"role": "assistant", "content": contenido, "refusal": None}}],
+            "usage": {"prompt_tokens": tokens_entrada, "completion_tokens": tokens_salida, "total_tokens": tokens_entrada + tokens_salida},
+        }
+
+    def embeddings(self, cuerpo):
+        textos = cuerpo["input"] if isinstance(cuerpo["input"], list) else [cuerpo["input"]]
+        datos = []
+        for indice, texto in enumerate(textos):
+            # Vector determinista por texto: textos distintos quedan casi ortogonales
+            semilla = int.from_bytes(hashlib.sha256(str(texto).encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(semilla).standard_normal(self.dimension_embedding).astype(np.float32)
+            if cuerpo.get("encoding_format") == "base64":
+                valor = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                valor = vector.tolist()
+            datos.append({"object": "embedding", "index": indice, "embedding": valor})
+        return {"object": "list", "data": datos, "model": cuerpo.get("model", ""), "usage": {"prompt_tokens": 1, "total_tokens": 1}}
+
+    @staticmethod
+    def audio(cuerpo):
+        # ~1 KB por cada 16 caracteres, del orden de un MP3 real de voz
+        return b"\xff\xfb" * (len(cuerpo.get("input", "")) * 32)
+
+    # Respuestas de Replicate
+    def prediccion(self, id_prediccion):
+        return {
+            "id": id_prediccion, "model": "black-forest-labs/flux-1.1-pro", "version": "bench", "input": {}, "logs": "",
+            "output": f"{self.url}/imagenes/{id_prediccion}.png", "error": None, "status": "succeeded",
+            "created_at": "2024-01-01T00:00:00Z", "urls": {"get": f"{self.url}/v1/predictions/{id_prediccion}"},
+        }
+
+    def _manejador(self):
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _responder(self, cuerpo, tipo="application/json", estado=200):
+                datos = json.dumps(cuerpo).encode("utf-8") if tipo == "application/json" else cuerpo
+                self.send_response(estado)
+                self.send_header("Content-Type", tipo)
+                self.send_header("Content-Length", str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def do_POST(self):
+                cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.endswith("/chat/completions"):
+                    servidor.esperar("openai")
+                    self._responder(servidor.chat(cuerpo))
+                elif self.path.endswith("/embeddings"):
+                    servidor.esperar("openai")
+                    self._responder(servidor.embeddings(cuerpo))
+                elif self.path.endswith("/audio/speech"):
+                    servidor.esperar("tts")
+                    self._responder(servidor.audio(cuerpo), tipo="audio/mpeg")
+                elif self.path.endswith("/predictions"):
+                    servidor.esperar("replicate")
+                    self._responder(servidor.prediccion(f"p{time.perf_counter_ns():x}"), estado=201)
+                else:
+                    self._responder({"error": f"ruta desconocida {self.path}"}, estado=404)
+
+            def do_GET(self):
+                coincidencia = re.match(r"^/v1/predictions/([^/]+)$", self.path)
+                if coincidencia:
+                    self._responder(servidor.prediccion(coincidencia.group(1)))
+                elif self.path.startswith("/imagenes/"):
+                    self._responder(servidor.png, tipo="image/png")
+                else:
+                    self._responder({"error": f"ruta desconocida {self.path}"}, estado=404)
+
+        return Manejador
+
+#------------------------------------------------------ MusicGen de juguete ---------------------------------------------------#
+
+class MusicGenFalso:
+    """Sustituto del pipeline text-to-audio: tarda `latencia` segundos por cada 512 tokens y devuelve un tono."""
+    def __init__(self, latencia, sampling_rate=32000):
+        self.latencia = latencia
+        self.sampling_rate = sampling_rate
+
+    def _uno(self, prompt, max_new_tokens):
+        muestras = int(max_new_tokens / 50 * self.sampling_rate)
+        frecuencia = 110 + int(hashlib.md5(prompt.encode("utf-8")).hexdigest()[:2], 16)
+        t = np.arange(muestras, dtype=np.float32) / self.sampling_rate
+        return {"audio": (0.3 * np.sin(2 * np.pi * frecuencia * t))[None, :], "sampling_rate": self.sampling_rate}
+
+    def __call__(self, prompts, forward_params=None, batch_size=None):
+        max_new_tokens = (forward_params or {}).get("max_new_tokens", 512)
+        time.sleep(self.latencia * max_new_tokens / 512)
+        if isinstance(prompts, str):
+            return self._uno(prompts, max_new_tokens)
+        return [self._uno(prompt, max_new_tokens) for prompt in prompts]
+
+#------------------------------------------------------ Libro sintético -------------------------------------------------------#
+
+# Función que escribe un PDF mínimo de `paginas` páginas con texto (Helvetica) sin dependencias externas
+def pdf_sintetico(paginas, palabras_por_pagina=250, semilla=0):
+    rng = np.random.default_rng(semilla)
+    objetos = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    hijos = []
+    for _ in range(paginas):
+        palabras = rng.choice(VOCABULARIO, size=palabras_por_pagina)
+        lineas = [" ".join(palabras[i:i + 12]) for i in range(0, len(palabras), 12)]
+        texto = "".join(f"({linea}) Tj T* " for linea in lineas)
+        flujo = f"BT /F1 11 Tf 14 TL 50 780 Td {texto}ET".encode("latin-1")
+        objetos.append(f"<< /Length {len(flujo)} >>\nstream\n".encode("latin-1") + flujo + b"\nendstream")
+        objetos.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objetos)} 0 R >>")
+        hijos.append(f"{len(objetos)} 0 R")
+    objetos[1] = f"<< /Type /Pages /Kids [{' '.join(hijos)}] /Count {paginas} >>"
+
+    salida = BytesIO()
+    salida.write(b"%PDF-1.4\n")
+    posiciones = []
+    for numero, objeto in enumerate(objetos, start=1):
+        posiciones.append(salida.tell())
+        contenido = objeto if isinstance(objeto, bytes) else objeto.encode("latin-1")
+        salida.write(f"{numero} 0 obj\n".encode("latin-1") + contenido + b"\nendobj\n")
+    inicio_xref = salida.tell()
+    salida.write(f"xref\n0 {len(objetos) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+    for posicion in posiciones:
+        salida.write(f"{posicion:010d} 00000 n \n".encode("latin-1"))
+    salida.write(f"trailer\n<< /Size {len(objetos) + 1} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n".encode("latin-1"))
+    return salida.getvalue()
+
+#------------------------------------------------------ Medición -------------------------------------------------------------#
+
+class Mediciones:
+    """Latencias por etapa (segundos) y errores, compartidas por todos los lectores simulados."""
+    def __init__(self):
+        self.latencias = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.mensajes_error = {}
+        self._lock = threading.Lock()
+
+    def medir(self, etapa, funcion, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            resultado = funcion(*args, **kwargs)
+        except Exception as exc:
+            with self._lock:
+                self.errores[etapa] += 1
+                self.mensajes_error.setdefault(etapa, repr(exc)[:200])
+            return None
+        with self._lock:
+            self.latencias[etapa].append(time.perf_counter() - inicio)
+        return resultado
+
+    def resumen(self):
+        etapas = {}
+        for etapa in ETAPAS:
+            valores = np.asarray(self.latencias.get(etapa, []), dtype=np.float64)
+            if not len(valores) and not self.errores.get(etapa):
+                continue
+            p50, p95, p99 = np.percentile(valores, (50, 95, 99)) if len(valores) else (None, None, None)
+            etapas[etapa] = {
+                "n": int(len(valores)),
+                "errores": self.errores.get(etapa, 0),
+                "media": round(float(valores.mean()), 4) if len(valores) else None,
+                "p50": round(float(p50), 4) if p50 is not None else None,
+                "p95": round(float(p95), 4) if p95 is not None else None,
+                "p99": round(float(p99), 4) if p99 is not None else None,
+                "max": round(float(valores.max()), 4) if len(valores) else None,
+            }
+            if etapa in self.mensajes_error:
+                etapas[etapa]["primer_error"] = self.mensajes_error[etapa]
+        return etapas
+
+# Memoria máxima del proceso (RSS) en MB
+def rss_maximo_mb():
+    maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB y macOS en bytes
+    return round(maximo / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+#------------------------------------------------------ Lector simulado -------------------------------------------------------#
+
+# Función que pasa una página por el pipeline como lo hace la app: lo independiente en paralelo, lo encadenado en orden
+def lee_pagina(tools, documento, page_number, mediciones, render):
+    inicio = time.perf_counter()
+    if render:
+        mediciones.medir("render", documento.render, page_number)
+    text = mediciones.medir("clean_text", documento.texto, page_number)
+    if not text:
+        return
+
+    def musica():
+        prompt_musica = mediciones.medir("prompt_musica", tools.text_to_music, text)
+        if prompt_musica:
+            mediciones.medir("musicgen", tools.musicgen_generation, prompt_musica)
+
+    def imagen():
+        prompt_imagen = mediciones.medir("prompt_imagen", tools.text_to_imagen, text)
+        if prompt_imagen:
+            mediciones.medir("imagen", lambda: tools.materializar_imagen(tools.url_imagen(tools.crea_imagen(prompt_imagen))))
+
+    futuros = tools.lanzar_tareas({
+        "tts": (mediciones.medir, "tts", tools.text_to_speech_completo, text),
+        "sentimientos": (mediciones.medir, "sentimientos", tools.vector_sentimientos, text),
+        "insights": (mediciones.medir, "insights", tools.get_book_insights, tools.get_client(), text),
+        "musica": (musica,),
+        "imagen": (imagen,),
+    })
+    for futuro in futuros.values():
+        futuro.result()
+    with mediciones._lock:
+        mediciones.latencias["pagina"].append(time.perf_counter() - inicio)
+
+# Función que simula un lector: abre el libro y recorre sus páginas una tras otra
+def lector(tools, pdf_module, pdf_bytes, paginas, mediciones, render):
+    documento = mediciones.medir("parse", pdf_module.DocumentoPDF, pdf_bytes)
+    for page_number in paginas:
+        lee_pagina(tools, documento, page_number, mediciones, render)
+
+# Función que corre una ronda con `lectores` lectores simultáneos y devuelve sus mediciones
+def ronda(tools, pdf_module, pdf_bytes, lectores, paginas_por_lector, primera_pagina, mismas_paginas, render):
+    mediciones = Mediciones()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    planes = []
+    for indice in range(lectores):
+        desde = primera_pagina if mismas_paginas else primera_pagina + indice * paginas_por_lector
+        planes.append(range(desde, desde + paginas_por_lector))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=lectores, thread_name_prefix="bookslives-bench-lector") as executor:
+        for futuro in [executor.submit(lector, tools, pdf_module, pdf_bytes, plan, mediciones, render) for plan in planes]:
+            futuro.result()
+    duracion = time.perf_counter() - inicio
+
+    paginas_leidas = len(mediciones.latencias["pagina"])
+    resultado = {
+        "lectores": lectores,
+        "paginas": paginas_leidas,
+        "duracion_s": round(duracion, 3),
+        "paginas_por_segundo": round(paginas_leidas / duracion, 3) if duracion > 0 else None,
+        "etapas": mediciones.resumen(),
+        "rss_maximo_mb": rss_maximo_mb(),
+    }
+    if tracemalloc.is_tracing():
+        resultado["python_pico_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+    return resultado
+
+#------------------------------------------------------ Comparación -----------------------------------------------------------#
+
+# Función que imprime la diferencia de p50/p95 y rendimiento contra un resultado anterior
+def comparar(actual, anterior):
+    print(f"\nComparación {anterior.get('commit')} -> {actual.get('commit')}")
+    rondas_anteriores = {r["lectores"]: r for r in anterior.get("rondas", [])}
+    for r in actual["rondas"]:
+        previa = rondas_anteriores.get(r["lectores"])
+        if previa is None:
+            continue
+        print(f"  {r['lectores']} lectores: {previa['paginas_por_segundo']} -> {r['paginas_por_segundo']} páginas/s")
+        for etapa, datos in r["etapas"].items():
+            antes = previa["etapas"].get(etapa)
+            if not antes or antes.get("p50") is None or datos.get("p50") is None:
+                continue
+            cambio = 100 * (datos["p50"] - antes["p50"]) / antes["p50"] if antes["p50"] else 0.0
+            print(f"    {etapa:<14} p50 {antes['p50']:.3f}s -> {datos['p50']:.3f}s ({cambio:+.1f}%)  "
+                  f"p95 {antes['p95']:.3f}s -> {datos['p95']:.3f}s")
+
+#------------------------------------------------------ Punto de entrada -----------------------------------------------------#
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de página de BooksLives.")
+    parser.add_argument("--pdf", help="PDF a usar (por defecto se genera un libro sintético)")
+    parser.add_argument("--lectores", type=int, nargs="+", default=[1, 4], help="Lectores simultáneos de cada ronda")
+    parser.add_argument("--paginas", type=int, default=3, help="Páginas que lee cada lector")
+    parser.add_argument("--mismas-paginas", action="store_true", help="Todos los lectores leen las mismas páginas (mide la deduplicación)")
+    parser.add_argument("--sin-render", action="store_true", help="No renderiza las páginas (p. ej. si no está poppler)")
+    parser.add_argument("--latencia-openai", type=float, default=0.2, help="Segundos por llamada de chat/embeddings")
+    parser.add_argument("--latencia-tts", type=float, default=0.4, help="Segundos por llamada de voz")
+    parser.add_argument("--latencia-replicate", type=float, default=1.0, help="Segundos por imagen de Replicate")
+    parser.add_argument("--latencia-musicgen", type=float, default=0.5, help="Segundos del MusicGen de juguete por cada 512 tokens")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Media del retraso exponencial extra de cada llamada")
+    parser.add_argument("--tracemalloc", action="store_true", help="Mide también el pico de memoria de Python (más lento)")
+    parser.add_argument("--salida", help="Archivo JSON de resultados (por defecto bench_<commit>.json)")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior contra el que comparar")
+    args = parser.parse_args(argv)
+
+    # Almacén y progreso en una carpeta temporal: cada ejecución empieza en frío y no ensucia la caché real.
+    # Esto debe fijarse antes de importar los módulos de la app, que leen la configuración al importarse.
+    directorio = tempfile.mkdtemp(prefix="bookslives-bench-")
+    os.environ["BOOKSLIVES_CACHE_DIR"] = directorio
+    os.environ["MUSICGEN_WORKER"] = "0"
+
+    from openai import OpenAI
+    import replicate
+    import Pdf_BooksLives
+    import Tools_BooksLives
+    import Metricas_BooksLives
+
+    servidor = ServidorFalso(
+        {"openai": args.latencia_openai, "tts": args.latencia_tts, "replicate": args.latencia_replicate}, jitter=args.jitter
+    ).arrancar()
+    Tools_BooksLives.configurar_clientes(
+        openai=OpenAI(api_key="bench", base_url=f"{servidor.url}/v1", max_retries=0),
+        replicate=replicate.Client("bench", base_url=servidor.url),
+    )
+    Tools_BooksLives.modelo_musicgen._synthesiser = MusicGenFalso(args.latencia_musicgen)
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+    else:
+        pdf_bytes = pdf_sintetico(sum(args.lectores) * args.paginas)
+    num_pages = Pdf_BooksLives.DocumentoPDF(pdf_bytes).num_pages
+
+    render = not args.sin_render
+    if render:
+        try:
+            Pdf_BooksLives.DocumentoPDF(pdf_bytes).render(1, vecinas=0)
+        except Exception as exc:
+            print(f"Sin render de páginas ({exc!r}); usa --sin-render para omitir este aviso", file=sys.stderr)
+            render = False
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    # Cada ronda lee páginas que ninguna ronda anterior tocó, para que todas empiecen con el almacén frío
+    rondas = []
+    primera_pagina = 1
+    for lectores in args.lectores:
+        necesarias = args.paginas if args.mismas_paginas else lectores * args.paginas
+        if primera_pagina + necesarias - 1 > num_pages:
+            print(f"El PDF no tiene páginas suficientes para {lectores} lectores; ronda omitida", file=sys.stderr)
+            continue
+        resultado = ronda(Tools_BooksLives, Pdf_BooksLives, pdf_bytes, lectores, args.paginas, primera_pagina, args.mismas_paginas, render)
+        primera_pagina += necesarias
+        rondas.append(resultado)
+
+        print(f"\n{lectores} lectores: {resultado['paginas']} páginas en {resultado['duracion_s']}s "
+              f"({resultado['paginas_por_segundo']} páginas/s), RSS máximo {resultado['rss_maximo_mb']} MB")
+        for etapa, datos in resultado["etapas"].items():
+            if datos["p50"] is None:
+                print(f"  {etapa:<14} {datos['errores']} errores: {datos.get('primer_error')}")
+                continue
+            print(f"  {etapa:<14} n={datos['n']:<4} p50={datos['p50']:.3f}s p95={datos['p95']:.3f}s p99={datos['p99']:.3f}s"
+                  + (f" errores={datos['errores']}" if datos["errores"] else ""))
+
+    servidor.detener()
+    commit = commit_actual()
+    resultados = {
+        "commit": commit,
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "configuracion": {clave: valor for clave, valor in vars(args).items() if clave not in ("salida", "comparar")} | {"render": render},
+        "peticiones": dict(servidor.peticiones),
+        "almacen": Tools_BooksLives.almacen.stats() if hasattr(Tools_BooksLives, "almacen") else None,
+        "rondas": rondas,
+        # Acumulados de la instrumentación (bytes, tokens y caché por etapa y modelo) de todas las rondas
+        "metricas": [
+            {"etapa": etapa, "modelo": modelo, **{clave: valor for clave, valor in serie.items() if clave != "cubetas"}}
+            for (etapa, modelo), serie in sorted(Metricas_BooksLives.registro.resumen().items())
+        ],
+    }
+    salida = args.salida or f"bench_{commit}.json"
+    with open(salida, "w") as f:
+        json.dump(resultados, f, indent=2, ensure_ascii=False, default=str)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, "r") as f:
+            comparar(resultados, json.load(f))
+    return 1 if any(datos["errores"] for r in rondas for datos in r["etapas"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
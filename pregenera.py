@@ -0,0 +1,150 @@
+# pregenera.py
+# Pre-generación offline de un libro completo: recorre todas las páginas del PDF con el pipeline de Tools_BooksLives
+# y deja los resultados en el almacén persistente que luego lee la app de Streamlit.
+#
+# Uso:
+#   python pregenera.py libro.pdf --paginas-paralelo 4 --openai 8 --musicgen 1 --replicate 2
+
+# Librerias a utilizar
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Cache_BooksLives import CACHE_DIR, configurar_limites
+from Metricas_BooksLives import iniciar_exportadores
+from Pdf_BooksLives import cargar_documento
+from Tools_BooksLives import (
+    get_client, SENTIMIENTO_BACKEND, get_book_insights, text_to_music, musica_semantica,
+    text_to_imagen, imagen_semantica, url_imagen, materializar_imagen, text_to_speech_completo,
+    cache_semantica_musica, cache_semantica_imagen, linea_emociones, MOOD_LOCAL,
+)
+
+# Modelo de voz que usa la app para el audiolibro
+MODEL_TTS = "gpt-4o-mini-tts"
+
+#------------------------------------------------------ Registro de avance (reanudable) -----------------------------------------#
+
+class RegistroAvance:
+    """Páginas ya procesadas de un libro, guardadas junto al almacén para poder reanudar tras una interrupción."""
+    def __init__(self, pdf_id, directorio=CACHE_DIR):
+        os.makedirs(directorio, exist_ok=True)
+        self.ruta = os.path.join(directorio, f"pregenera_{pdf_id}.json")
+        self._lock = threading.Lock()
+        if os.path.exists(self.ruta):
+            with open(self.ruta, "r") as f:
+                self.hechas = set(json.load(f))
+        else:
+            self.hechas = set()
+
+    def marcar(self, page_number):
+        with self._lock:
+            self.hechas.add(page_number)
+            temporal = f"{self.ruta}.tmp"
+            with open(temporal, "w") as f:
+                json.dump(sorted(self.hechas), f)
+            os.replace(temporal, self.ruta)
+
+#------------------------------------------------------ Pipeline por página ---------------------------------------------------#
+
+# Función que ejecuta el pipeline completo sobre una página (la concurrencia de cada backend la limita Cache_BooksLives)
+def procesa_pagina(documento, page_number, pasos):
+    text = documento.texto(page_number)
+    if not text.strip():
+        return {}
+
+    tiempos = {}
+    def paso(nombre, funcion, *args, **kwargs):
+        inicio = time.perf_counter()
+        resultado = funcion(*args, **kwargs)
+        tiempos[nombre] = round(time.perf_counter() - inicio, 3)
+        return resultado
+
+    # Las emociones ya se calcularon para todo el libro antes de este paso; el ánimo suavizado de las páginas
+    # cercanas se añade a la música y la imagen igual que en la app (sólo si se van a generar)
+    mood = None
+    if MOOD_LOCAL and ("musica" in pasos or "imagen" in pasos):
+        mood = linea_emociones(documento).mood_local(page_number)
+    if "insights" in pasos:
+        paso("insights", get_book_insights, get_client(), book_text=text)
+    if "audiolibro" in pasos:
+        paso("audiolibro", text_to_speech_completo, text, model_name=MODEL_TTS, voice="onyx")
+    if "musica" in pasos:
+        prompt_musica = paso("prompt_musica", text_to_music, text)
+        if prompt_musica:
+            paso("musica", musica_semantica, prompt_musica, mood=mood)
+    if "imagen" in pasos:
+        prompt_imagen = paso("prompt_imagen", text_to_imagen, text)
+        if prompt_imagen:
+            output = paso("imagen", imagen_semantica, prompt_imagen, mood=mood)
+            if output:
+                paso("imagen_local", materializar_imagen, url_imagen(output))
+    return tiempos
+
+#------------------------------------------------------ Punto de entrada -----------------------------------------------------#
+
+PASOS = ("sentimientos", "insights", "audiolibro", "musica", "imagen")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-genera audiolibro, música, insights, sentimientos e imágenes de un PDF.")
+    parser.add_argument("pdf", help="Ruta del libro en PDF")
+    parser.add_argument("--desde", type=int, default=1, help="Primera página a procesar")
+    parser.add_argument("--hasta", type=int, default=None, help="Última página a procesar")
+    parser.add_argument("--pasos", nargs="+", choices=PASOS, default=list(PASOS), help="Pasos del pipeline a ejecutar")
+    parser.add_argument("--paginas-paralelo", type=int, default=4, help="Páginas procesadas a la vez")
+    parser.add_argument("--openai", type=int, default=8, help="Llamadas simultáneas máximas a OpenAI")
+    parser.add_argument("--musicgen", type=int, default=1, help="Generaciones simultáneas máximas de MusicGen")
+    parser.add_argument("--replicate", type=int, default=2, help="Llamadas simultáneas máximas a Replicate")
+    parser.add_argument("--reiniciar", action="store_true", help="Ignora el registro de avance y procesa todas las páginas")
+    args = parser.parse_args(argv)
+
+    with open(args.pdf, "rb") as f:
+        documento = cargar_documento(f.read())
+
+    hasta = min(args.hasta or documento.num_pages, documento.num_pages)
+    registro = RegistroAvance(documento.pdf_id)
+    if args.reiniciar:
+        registro.hechas.clear()
+    pendientes = [p for p in range(max(1, args.desde), hasta + 1) if p not in registro.hechas]
+    print(f"{documento.pdf_id}: {documento.num_pages} páginas, {len(pendientes)} pendientes")
+
+    configurar_limites(openai=args.openai, musicgen=args.musicgen, replicate=args.replicate)
+    # Con BOOKSLIVES_METRICAS_ARCHIVO o BOOKSLIVES_METRICAS_PUERTO la pre-generación también exporta sus métricas
+    iniciar_exportadores()
+
+    # Las emociones de todas las páginas van primero: llenan la línea de tiempo del libro de la que sale el ánimo
+    # suavizado de cada página. Con el clasificador local se puntúan de una vez en lotes.
+    if "sentimientos" in args.pasos and pendientes:
+        inicio = time.perf_counter()
+        linea = linea_emociones(documento)
+        if SENTIMIENTO_BACKEND == "local":
+            linea.puntuar_lote(pendientes)
+        else:
+            with ThreadPoolExecutor(max_workers=args.paginas_paralelo) as executor:
+                list(executor.map(linea.puntuar, pendientes))
+        print(f"Sentimientos de {len(pendientes)} páginas en {time.perf_counter() - inicio:.2f}s")
+
+    errores = 0
+    with ThreadPoolExecutor(max_workers=args.paginas_paralelo) as executor:
+        futuros = {executor.submit(procesa_pagina, documento, p, set(args.pasos)): p for p in pendientes}
+        for futuro in as_completed(futuros):
+            page_number = futuros[futuro]
+            try:
+                tiempos = futuro.result()
+            except Exception as exc:
+                errores += 1
+                print(f"Página {page_number}: error {exc}", file=sys.stderr)
+                continue
+            registro.marcar(page_number)
+            print(f"Página {page_number}: {tiempos}")
+
+    print(f"Terminado: {len(pendientes) - errores} páginas procesadas, {errores} con error")
+    print(f"Reutilización semántica: música {cache_semantica_musica.stats()}, imagen {cache_semantica_imagen.stats()}")
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())